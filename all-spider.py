@@ -1,7 +1,10 @@
 from spider import *
+import multiprocessing
 import sys
 
 if __name__ == '__main__':
+    # 打包成exe之后 解析进程需要这个才能正常启动
+    multiprocessing.freeze_support()
     spider_list = (
         (RankSpider, '排名'),
         (SiteSpider, '收录'),
@@ -29,9 +32,18 @@ if __name__ == '__main__':
     else:
         engine_index = input('''要查找哪个搜索引擎？
 %s
-''' % '\n'.join(['%s 请输入：%s' % (ruler_name, i) for (i, (_, ruler_name)) in enumerate(engine_list)]))
+%s 请输入：%s（只支持查询排名）
+''' % ('\n'.join(['%s 请输入：%s' % (ruler_name, i) for (i, (_, ruler_name)) in enumerate(engine_list)]),
+       '全部', len(engine_list)))
 
     (spider_class, spider_name) = spider_list[int(spider_index)]
-    (ruler_class_, ruler_name) = engine_list[int(engine_index)]
-    os.system('title %s%s' % (ruler_name, spider_name))
-    spider_class(ruler_class_)
+    if int(engine_index) == len(engine_list):
+        if spider_class is not RankSpider:
+            input('全部搜索引擎一起查询只支持查询排名')
+            sys.exit()
+        os.system('title %s%s' % ('全部', spider_name))
+        AllRankSpider([ruler_class_ for (ruler_class_, _) in engine_list])
+    else:
+        (ruler_class_, ruler_name) = engine_list[int(engine_index)]
+        os.system('title %s%s' % (ruler_name, spider_name))
+        spider_class(ruler_class_)
@@ -0,0 +1,87 @@
+import json
+import os
+from datetime import datetime
+
+JOURNAL_DIR = '断点记录'
+
+
+class CrawlJournal:
+    """一个搜索引擎查询一个导入文件的断点记录，每查完一页就追加一行，程序中断之后重新运行可以跳过已经完成的部分"""
+
+    def __init__(self, engine_name, filename):
+        self.path = os.path.join(JOURNAL_DIR, '%s-%s.jsonl' % (engine_name, filename))
+        self.file = None
+        # 只有从文件读出来的记录，恢复之后就删掉；这次查询新写的记录只写到文件，内存占用不会随着关键词增加
+        # keyword -> {page: record}
+        self.pages = {}
+        self.done_keywords = set()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 程序中断的时候最后一行可能没有写完整
+                    continue
+                if record['type'] == 'page':
+                    self.pages.setdefault(record['keyword'], {})[record['page']] = record
+                elif record['type'] == 'done':
+                    self.done_keywords.add(record['keyword'])
+
+    def has_record(self):
+        return len(self.pages) != 0 or len(self.done_keywords) != 0
+
+    def write(self, record):
+        if self.file is None:
+            os.makedirs(JOURNAL_DIR, exist_ok=True)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def record_page(self, keyword, page, result, unsafe_items, next_page_url, has_next_page):
+        record = {
+            'type': 'page',
+            'keyword': keyword,
+            'page': page,
+            'result': [(domain, keyword, page, rank, url, title, date_time.timestamp())
+                       for (domain, keyword, page, rank, url, title, date_time) in result],
+            'unsafe': unsafe_items,
+            'next_page_url': next_page_url,
+            'has_next_page': has_next_page,
+        }
+        self.write(record)
+
+    def record_done(self, keyword):
+        self.pages.pop(keyword, None)
+        self.done_keywords.discard(keyword)
+        self.write({'type': 'done', 'keyword': keyword})
+
+    def is_done(self, keyword):
+        return keyword in self.done_keywords
+
+    # 返回这个关键词已经完成的页，按页数排序，结果里面的时间已经转换回datetime；每个关键词只恢复一次
+    def get_pages(self, keyword):
+        pages = []
+        keyword_pages = self.pages.pop(keyword, {})
+        for page in sorted(keyword_pages.keys()):
+            record = dict(keyword_pages[page])
+            record['result'] = [(domain, keyword, page, rank, url, title, datetime.fromtimestamp(timestamp))
+                                for (domain, keyword, page, rank, url, title, timestamp) in record['result']]
+            record['unsafe'] = [tuple(item) for item in record['unsafe']]
+            pages.append(record)
+        return pages
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    # 整个文件正常查询完毕并且保存了结果之后就不再需要断点记录了
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
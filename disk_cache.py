@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = '缓存'
+# 命中的记录的使用时间先记在内存里面，攒够这么多条或者要删除旧记录的时候再一起写到数据库
+USED_FLUSH_COUNT = 1000
+
+
+class DiskCache:
+    """保存在sqlite文件里面的缓存（例如跳转链接 -> 真实地址），不同关键词、不同搜索引擎、下次运行都可以直接使用
+    超过ttl秒的记录不再使用，记录超过max_size条的时候删掉最久没有用到的"""
+
+    def __init__(self, name, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.insert_count = 0
+        # key -> 最近一次命中的时间，还没有写到数据库
+        self.used = {}
+        self.conn = None
+        if ttl <= 0:
+            return
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(CACHE_DIR, name), check_same_thread=False, timeout=30)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                          '(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        self.conn.commit()
+
+    def get(self, key):
+        if self.conn is None:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.ttl < now:
+                self.conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.conn.commit()
+                return None
+            self.used[key] = now
+            if len(self.used) >= USED_FLUSH_COUNT:
+                self.flush_used()
+                self.conn.commit()
+            return row[0]
+
+    def set(self, key, value):
+        if self.conn is None or value is None:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', (key, value, now, now))
+            self.used.pop(key, None)
+            self.insert_count += 1
+            # 不用每次都数一遍，每写入1000条检查一次
+            if self.insert_count % 1000 == 0:
+                self.flush_used()
+                self.evict()
+            self.conn.commit()
+
+    def flush_used(self):
+        self.conn.executemany('UPDATE entries SET used = ? WHERE key = ?',
+                              [(used, key) for key, used in self.used.items()])
+        self.used = {}
+
+    def evict(self):
+        count = self.conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        if count > self.max_size:
+            self.conn.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used LIMIT ?)',
+                              (count - self.max_size,))
+
+
+caches = {}
+
+
+# 同一个文件只打开一次，同时查询多个搜索引擎的时候共用
+def open_disk_cache(name, ttl, max_size):
+    if name not in caches:
+        caches[name] = DiskCache(name, ttl, max_size)
+    return caches[name]
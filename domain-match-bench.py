@@ -0,0 +1,87 @@
+import random
+import sys
+import time
+from urllib.parse import urlparse
+
+from spider import DomainMatcher
+
+# 比较DomainMatcher和原来逐个域名比较的方式的速度，同时核对两种方式的结果是否一致
+# 用法：python domain-match-bench.py [域名数量] [网址数量]
+DOMAIN_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+URL_COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+SUFFIXES = ('com', 'cn', 'com.cn', 'net', 'org', 'gov.cn')
+PREFIXES = ('www', 'm', 'wap', 'news', 'bbs')
+
+
+# 原来RankSpider和LittleRankSpider里面用的判断方法
+def is_list_include_another_list(child_list, parent_list):
+    if child_list[0] in parent_list:
+        index = parent_list.index(child_list[0])
+        for i, child in enumerate(child_list):
+            if child not in parent_list or parent_list.index(child) != index + i:
+                return False
+        return True
+    else:
+        return False
+
+
+def match_by_list(domain_set, netloc):
+    item_list = netloc.split('.')
+    for domain in domain_set:
+        if domain == '*' or is_list_include_another_list(domain.split('.'), item_list):
+            return domain
+    return None
+
+
+def create_data(random_generator):
+    domain_set = set()
+    while len(domain_set) < DOMAIN_COUNT:
+        domain_set.add('site%s.%s' % (random_generator.randrange(DOMAIN_COUNT * 10),
+                                      random_generator.choice(SUFFIXES)))
+    domains = sorted(domain_set)
+    urls = []
+    for i in range(URL_COUNT):
+        # 大约一成的网址属于要查的域名，和真实的搜索结果差不多
+        if random_generator.random() < 0.1:
+            domain = random_generator.choice(domains)
+        else:
+            domain = 'other%s.%s' % (i, random_generator.choice(SUFFIXES))
+        urls.append('http://%s.%s/page/%s.html' % (random_generator.choice(PREFIXES), domain, i))
+    return domain_set, urls
+
+
+def run(match, urls):
+    start = time.perf_counter()
+    results = [match(urlparse(url).netloc) for url in urls]
+    return time.perf_counter() - start, results
+
+
+def main():
+    (domain_set, urls) = create_data(random.Random(0))
+    start = time.perf_counter()
+    matcher = DomainMatcher(domain_set)
+    compile_time = time.perf_counter() - start
+    (list_time, list_results) = run(lambda netloc: match_by_list(domain_set, netloc), urls)
+    (matcher_time, matcher_results) = run(matcher.match, urls)
+    # 一个网址同时符合多个域名的时候原来的方式返回的是集合里面先遍历到的那个，DomainMatcher返回标签最多的那个，不算不一致
+    diff_count = 0
+    multiple_count = 0
+    for url, list_result, matcher_result in zip(urls, list_results, matcher_results):
+        if list_result == matcher_result:
+            continue
+        if list_result is not None and matcher_result is not None and is_list_include_another_list(
+                matcher_result.split('.'), urlparse(url).netloc.split('.')):
+            multiple_count += 1
+        else:
+            diff_count += 1
+    print('%s个域名，%s个网址，其中%s个网址属于要查的域名'
+          % (len(domain_set), len(urls), sum(1 for result in list_results if result is not None)))
+    print('原来的方式：%.4f秒，每个网址%.2f微秒' % (list_time, list_time / len(urls) * 1e6))
+    print('DomainMatcher：%.4f秒，每个网址%.2f微秒（编译用时%.4f秒），快了%.1f倍'
+          % (matcher_time, matcher_time / len(urls) * 1e6, compile_time, list_time / matcher_time))
+    print('同时符合多个域名的网址有%s个，结果不一致的网址有%s个' % (multiple_count, diff_count))
+    return diff_count
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() else 0)
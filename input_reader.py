@@ -0,0 +1,90 @@
+import csv
+import hashlib
+import os
+
+from openpyxl import load_workbook
+
+INPUT_EXTENSIONS = ('.xlsx', '.csv', '.tsv', '.txt')
+
+
+# 导入目录里面的xlsx、csv和tsv（txt按tsv处理）文件，跳过Excel打开文件时生成的~$临时文件
+def list_input_files(path):
+    files = []
+    for file in os.listdir(path):
+        if not file.startswith('~$') and os.path.splitext(file)[1].lower() in INPUT_EXTENSIONS:
+            files.append(file)
+    return files
+
+
+def get_file_hash(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def get_csv_encoding(file_path):
+    # 从Excel另存为的csv一般是gbk，其他工具导出的一般是utf-8
+    try:
+        with open(file_path, encoding='utf-8-sig') as f:
+            for _ in f:
+                pass
+        return 'utf-8-sig'
+    except UnicodeDecodeError:
+        return 'gbk'
+
+
+# 一行一行读取第一个工作表，不会把整个文件都加载到内存里面
+# 空白单元格是None，columns不为空的时候每行都补齐或者截断到columns列
+def read_rows(file_path, min_row=1, columns=None):
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.xlsx':
+        rows = read_xlsx_rows(file_path, min_row)
+    else:
+        rows = read_csv_rows(file_path, min_row, ',' if extension == '.csv' else '\t')
+    for row in rows:
+        if columns is not None:
+            row = (tuple(row) + (None,) * columns)[:columns]
+        yield row
+
+
+def read_xlsx_rows(file_path, min_row):
+    wb = load_workbook(file_path, read_only=True)
+    try:
+        yield from wb.active.iter_rows(min_row=min_row, values_only=True)
+    finally:
+        wb.close()
+
+
+def read_csv_rows(file_path, min_row, delimiter):
+    with open(file_path, newline='', encoding=get_csv_encoding(file_path)) as f:
+        for index, row in enumerate(csv.reader(f, delimiter=delimiter)):
+            if index + 1 >= min_row:
+                yield tuple(cell if cell.strip() != '' else None for cell in row)
+
+
+class InputCache:
+    """导入文件解析之后的结果按文件缓存起来，定时运行的时候没有改过的文件不用重新解析
+    修改时间和大小都没变就直接使用缓存；修改时间变了再比较文件内容的hash，内容一样也使用缓存"""
+
+    def __init__(self):
+        # (文件路径, 解析方式) -> (修改时间, 大小, hash, 解析结果)
+        self.cache = {}
+
+    def load(self, file_path, parse, *args):
+        key = (os.path.abspath(file_path), parse.__name__, args)
+        stat = os.stat(file_path)
+        cached = self.cache.get(key)
+        if cached is not None and (cached[0], cached[1]) == (stat.st_mtime_ns, stat.st_size):
+            return cached[3]
+        file_hash = get_file_hash(file_path)
+        if cached is not None and cached[2] == file_hash:
+            self.cache[key] = (stat.st_mtime_ns, stat.st_size, file_hash, cached[3])
+            return cached[3]
+        result = parse(file_path, *args)
+        self.cache[key] = (stat.st_mtime_ns, stat.st_size, file_hash, result)
+        return result
+
+
+input_cache = InputCache()
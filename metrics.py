@@ -0,0 +1,177 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 请求搜索结果页耗时的直方图分段(单位：秒)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class EngineMetrics:
+    """一个搜索引擎的查询进度和请求统计，只在内存里面累加，查看的时候由MetricsServer汇总"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.requests = 0
+        self.pages = 0
+        self.forbids = 0
+        self.retries = 0
+        self.resolves = 0
+        self.latency_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.keyword_count = 0
+        self.keywords_done = 0
+
+    # 开始查询一个导入文件，进度和速度从这里重新算
+    def begin_keywords(self, count):
+        with self.lock:
+            self.start_time = time.monotonic()
+            self.pages = 0
+            self.keyword_count = count
+            self.keywords_done = 0
+
+    def on_keyword_done(self):
+        with self.lock:
+            self.keywords_done += 1
+
+    def on_request(self, latency):
+        index = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                index = i
+                break
+        with self.lock:
+            self.requests += 1
+            self.latency_counts[index] += 1
+            self.latency_sum += latency
+
+    def on_page(self):
+        with self.lock:
+            self.pages += 1
+
+    def on_forbid(self):
+        with self.lock:
+            self.forbids += 1
+
+    def on_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def on_resolve(self):
+        with self.lock:
+            self.resolves += 1
+
+    # 预计还要多少秒查完，还没有查完任何关键词的时候返回None
+    def get_eta(self, elapsed):
+        if self.keywords_done == 0:
+            return None
+        return elapsed / self.keywords_done * (self.keyword_count - self.keywords_done)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            return {
+                'requests': self.requests,
+                'pages': self.pages,
+                'pages_per_second': self.pages / elapsed if elapsed > 0 else 0,
+                'forbids': self.forbids,
+                'forbid_rate': self.forbids / self.requests if self.requests > 0 else 0,
+                'retries': self.retries,
+                'resolves': self.resolves,
+                'latency_buckets': list(zip(LATENCY_BUCKETS + ('+Inf',), self.latency_counts)),
+                'latency_sum': self.latency_sum,
+                'keywords': self.keyword_count,
+                'keywords_done': self.keywords_done,
+                'elapsed': elapsed,
+                'eta': self.get_eta(elapsed),
+            }
+
+
+class Metrics:
+    """所有搜索引擎的统计，开启了metrics_port的时候用HTTP提供：
+    /metrics是Prometheus的文本格式，/metrics.json是JSON，可以在一个监控页面上同时看所有搜索引擎"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.engines = {}
+        self.server = None
+
+    def engine(self, engine):
+        with self.lock:
+            if engine not in self.engines:
+                self.engines[engine] = EngineMetrics(engine)
+            return self.engines[engine]
+
+    def snapshot(self):
+        with self.lock:
+            engines = list(self.engines.values())
+        return {metrics.engine: metrics.snapshot() for metrics in engines}
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def add(name, kind, key):
+            lines.append('# TYPE spider_%s %s' % (name, kind))
+            for engine, values in snapshot.items():
+                if values[key] is not None:
+                    lines.append('spider_%s{engine="%s"} %s' % (name, engine, values[key]))
+
+        add('requests_total', 'counter', 'requests')
+        add('pages_total', 'counter', 'pages')
+        add('pages_per_second', 'gauge', 'pages_per_second')
+        add('forbids_total', 'counter', 'forbids')
+        add('forbid_rate', 'gauge', 'forbid_rate')
+        add('retries_total', 'counter', 'retries')
+        add('resolves_total', 'counter', 'resolves')
+        add('keywords', 'gauge', 'keywords')
+        add('keywords_done', 'gauge', 'keywords_done')
+        add('eta_seconds', 'gauge', 'eta')
+        lines.append('# TYPE spider_request_latency_seconds histogram')
+        for engine, values in snapshot.items():
+            total = 0
+            for bound, count in values['latency_buckets']:
+                total += count
+                lines.append('spider_request_latency_seconds_bucket{engine="%s",le="%s"} %s' % (engine, bound, total))
+            lines.append('spider_request_latency_seconds_sum{engine="%s"} %s' % (engine, values['latency_sum']))
+            lines.append('spider_request_latency_seconds_count{engine="%s"} %s' % (engine, total))
+        return '\n'.join(lines) + '\n'
+
+    # 在后台线程里面提供HTTP服务，重复调用只启动一次
+    def start_server(self, host, port):
+        with self.lock:
+            if self.server is not None:
+                return
+            self.server = ThreadingHTTPServer((host, port), make_handler(self))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print('查询进度和请求统计：http://%s:%s/metrics' % (host, port))
+
+
+def make_handler(metrics):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = metrics.to_prometheus().encode('utf-8')
+                content_type = 'text/plain; version=0.0.4; charset=utf-8'
+            elif self.path == '/metrics.json':
+                body = json.dumps(metrics.snapshot(), ensure_ascii=False).encode('utf-8')
+                content_type = 'application/json; charset=utf-8'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # 不要每次请求都输出到控制台
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+METRICS = Metrics()
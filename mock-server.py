@@ -0,0 +1,217 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import re
+from urllib.parse import urlsplit
+
+from aiohttp import web
+
+# 本地模拟搜索引擎，用fixtures目录下保存的页面代替真实的搜索结果，不会因为测试被封IP
+# python mock-server.py --port 8765 --latency 200 --error-rate 0.01 --captcha-rate 0.01 --pages 5
+# 然后在config.ini（状态查询是status-spider/config.ini）里面填上mock_server = http://127.0.0.1:8765
+# 请求的地址是 http://127.0.0.1:8765/<协议>/<真实域名>/<真实路径>，见mock_transport.py
+# --proxy-ports 8771 8772 --banned-ports 8771 另外监听几个端口当作本地的代理（代理池里面填http://127.0.0.1:8771），
+# 通过被封的端口请求搜索结果页都返回验证码页面，用来测试代理池能不能绕开被封的代理
+FIXTURE_DIR = 'fixtures'
+# 每个搜索引擎表示页数的参数：(参数名, 第一页的值, 每页增加多少)
+PAGE_PARAMS = {
+    'SMRuler': ('page', 1, 1),
+    'SogouPCRuler': ('page', 1, 1),
+    'SogouMobileRuler': ('p', 1, 1),
+    'BaiduPCRuler': ('pn', 0, 10),
+    'BaiduMobileRuler': ('pn', 0, 10),
+    'SLLPCRuler': ('pn', 1, 1),
+    'SLLMobileRuler': ('pn', 1, 1),
+}
+# 表示每页结果数的参数（large_page模式），一次请求算作普通模式下的好几页
+PAGE_SIZE_PARAMS = {
+    'BaiduPCRuler': 'rn',
+}
+# 搜索这个关键词的时候返回没有结果的页面
+NO_RESULT_KEYWORD = '没有结果'
+# 搜狗MOBILE的转码页，爬虫会用搜索结果页的规则检查转码页，所以要带上没有结果的页面信息
+SUB_PAGE = '''<html><body><p>0,0,0,0[PAGE_INFO]</p>
+<div class="btn"><a href="http://www.transcoding%s.com/">查看原网页</a></div></body></html>'''
+ERROR_PAGE = '<html><body><h1>503 Service Temporarily Unavailable</h1></body></html>'
+SITE_PAGE = '''<html><head><meta name="keywords" content="%s,模拟关键词">%s<title>%s</title></head>
+<body>模拟网站首页</body></html>'''
+RSS_PAGE = '''<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><item>
+<title>模拟文章</title><pubDate>Mon, 01 Jan 2024 10:00:00 +0000</pubDate></item></channel></rss>'''
+
+
+def read_fixture(path):
+    with open(path, encoding='utf-8') as f:
+        return urlsplit(f.readline().strip()), f.read()
+
+
+def route_key(url):
+    return url.scheme, url.netloc, url.path
+
+
+# 支持每页结果数的搜索引擎保存的页面里面，结果条目从第一个result开始，到翻页链接前面的</div>为止
+def split_items(text):
+    start = text.index('<div class="result')
+    end = text.rfind('</div>', 0, text.index('<div id="page">'))
+    return text[:start], text[start:end], text[end:]
+
+
+class Engine:
+    """一个搜索引擎保存的页面：第一页（有下一页）、最后一页、没有结果的页面、验证码页面"""
+
+    def __init__(self, name):
+        self.name = name
+        path = os.path.join(FIXTURE_DIR, name)
+        (self.url, self.page) = read_fixture(os.path.join(path, 'page-1.html'))
+        (_, self.last_page) = read_fixture(os.path.join(path, 'last-page.html'))
+        (_, self.no_result_page) = read_fixture(os.path.join(path, 'no-result.html'))
+        (self.forbid_url, self.forbid_page) = read_fixture(os.path.join(path, 'forbid.html'))
+
+    def get_page_number(self, query):
+        (name, first, step) = PAGE_PARAMS[self.name]
+        try:
+            return (int(query.get(name, first)) - first) // step + 1
+        except ValueError:
+            return 1
+
+    # 一次请求包含普通模式下的几页
+    def get_page_factor(self, query):
+        name = PAGE_SIZE_PARAMS.get(self.name)
+        try:
+            return max(int(query.get(name, 10)) // 10, 1) if name else 1
+        except ValueError:
+            return 1
+
+    # 一次请求包含factor页的时候，和真实的搜索引擎一样返回factor页的结果：前面每页重复保存的第一页的条目，
+    # 包含了最后一页的时候再加上最后一页的条目，并且没有下一页
+    def get_large_page(self, page, factor, pages):
+        last = min(page + factor - 1, pages)
+        items = ''.join(split_items(self.last_page if number == pages else self.page)[1]
+                        for number in range(page, last + 1))
+        (head, _, tail) = split_items(self.last_page if last == pages else self.get_page(page, factor))
+        return head + items + tail
+
+    # 保存的页面里面下一页链接固定是第二页，百度这种按照下一页链接翻页的搜索引擎要改成当前页的下一页
+    def get_page(self, page, factor):
+        (name, first, step) = PAGE_PARAMS[self.name]
+        next_value = first + (page - 1 + factor) * step
+        # 真实的搜索引擎下一页链接里面会带上每页结果数
+        size = '&amp;%s=%s' % (PAGE_SIZE_PARAMS[self.name], factor * 10) if factor > 1 else ''
+        return re.sub(r'([?&;]%s=)\d+' % name, lambda m: '%s%s%s' % (m.group(1), next_value, size), self.page)
+
+
+class MockServer:
+    def __init__(self, args):
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.engines = {}
+        self.forbid_pages = {}
+        self.counts = {}
+        for name in PAGE_PARAMS.keys():
+            engine = Engine(name)
+            self.engines[route_key(engine.url)] = engine
+            if route_key(engine.forbid_url) != route_key(engine.url):
+                self.forbid_pages[route_key(engine.forbid_url)] = engine.forbid_page
+
+    def count(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    async def handle(self, request):
+        scheme = request.match_info['scheme']
+        (netloc, _, path) = request.match_info['rest'].partition('/')
+        key = (scheme, netloc, '/' + path)
+        if self.args.latency > 0:
+            # 在设置的延迟上下浮动一半
+            await asyncio.sleep(self.args.latency / 1000 * self.random.uniform(0.5, 1.5))
+        if self.random.random() < self.args.error_rate:
+            self.count('错误')
+            return web.Response(status=503, text=ERROR_PAGE, content_type='text/html')
+        if key in self.engines:
+            return self.handle_search(self.engines[key], request)
+        if key in self.forbid_pages:
+            self.count('验证码')
+            return web.Response(text=self.forbid_pages[key], content_type='text/html')
+        if key[2].endswith('/link'):
+            # 百度、360的跳转链接，返回一个固定的目标网址
+            self.count('跳转')
+            digest = int(hashlib.md5(request.query_string.encode()).hexdigest(), 16)
+            raise web.HTTPFound('http://www.resolved%s.com/' % (digest % 10))
+        if key[2].startswith('/transcoding/sweb'):
+            self.count('转码页')
+            return web.Response(text=SUB_PAGE % request.query.get('id', ''), content_type='text/html')
+        return self.handle_site(netloc, key[2])
+
+    def handle_search(self, engine, request):
+        self.count(engine.name)
+        port = request.transport.get_extra_info('sockname')[1]
+        if port != self.args.port:
+            self.count('代理%s' % port)
+        if port in self.args.banned_ports or self.random.random() < self.args.captcha_rate:
+            self.count('验证码')
+            if route_key(engine.forbid_url) == route_key(engine.url):
+                return web.Response(text=engine.forbid_page, content_type='text/html')
+            url = engine.forbid_url
+            raise web.HTTPFound('/%s/%s%s?%s' % (url.scheme, url.netloc, url.path, url.query))
+        if NO_RESULT_KEYWORD in request.query_string or NO_RESULT_KEYWORD in ''.join(request.query.values()):
+            text = engine.no_result_page
+        elif engine.get_page_factor(request.query) > 1 and engine.get_page_number(request.query) < self.args.pages:
+            text = engine.get_large_page(engine.get_page_number(request.query), engine.get_page_factor(request.query),
+                                         self.args.pages)
+        elif engine.get_page_number(request.query) >= self.args.pages:
+            text = engine.last_page
+        else:
+            text = engine.get_page(engine.get_page_number(request.query), 1)
+        return web.Response(text=text, content_type='text/html')
+
+    # 状态查询请求的网站首页和RSS
+    def handle_site(self, netloc, path):
+        self.count('网站')
+        if path in ('/feed', '/rss.php'):
+            return web.Response(text=RSS_PAGE, content_type='text/xml')
+        generator = '<meta name="generator" content="WordPress">' if len(netloc) % 2 == 0 else ''
+        return web.Response(text=SITE_PAGE % (netloc, generator, netloc), content_type='text/html')
+
+    async def print_counts(self):
+        while True:
+            await asyncio.sleep(self.args.report_interval)
+            if len(self.counts) != 0:
+                print('已处理请求：%s' % '，'.join('%s %s' % item for item in sorted(self.counts.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0, help='每个请求的平均延迟（毫秒）')
+    parser.add_argument('--error-rate', type=float, default=0, help='返回503的比例')
+    parser.add_argument('--captcha-rate', type=float, default=0, help='返回验证码页面的比例')
+    parser.add_argument('--pages', type=int, default=3, help='每个关键词有多少页搜索结果')
+    parser.add_argument('--seed', type=int, default=None, help='随机数种子，方便重复同样的测试')
+    parser.add_argument('--report-interval', type=float, default=10, help='每隔多少秒输出一次请求数量')
+    parser.add_argument('--proxy-ports', type=int, nargs='*', default=[], help='当作代理的端口')
+    parser.add_argument('--banned-ports', type=int, nargs='*', default=[], help='被搜索引擎封掉的代理端口')
+    args = parser.parse_args()
+    asyncio.run(serve(args))
+
+
+# 代理收到的请求是完整的地址（GET http://127.0.0.1:8765/https/... HTTP/1.1），aiohttp取出路径之后和直接请求一样处理
+async def serve(args):
+    server = MockServer(args)
+    app = web.Application()
+    app.router.add_route('*', '/{scheme:https?}/{rest:.*}', server.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    for port in [args.port] + args.proxy_ports:
+        await web.TCPSite(runner, args.host, port).start()
+    print('模拟搜索引擎地址：http://%s:%s' % (args.host, args.port))
+    for port in args.proxy_ports:
+        print('模拟代理地址：http://%s:%s%s' % (args.host, port, '（被封）' if port in args.banned_ports else ''))
+    try:
+        await server.print_counts()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    main()
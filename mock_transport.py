@@ -0,0 +1,24 @@
+from urllib.parse import urlsplit
+
+# 配置了mock_server的时候所有请求都发到本地的模拟搜索引擎（mock-server.py），真实地址的协议和域名放到路径里面：
+# https://www.baidu.com/s?wd=1 → http://127.0.0.1:8765/https/www.baidu.com/s?wd=1
+# 返回的地址再换回真实地址，ruler里面根据地址判断是否被判定为爬虫、拼接下一页地址的逻辑都不需要改
+
+
+def to_mock_url(url, mock_server):
+    if not mock_server:
+        return url
+    parts = urlsplit(url)
+    if not parts.scheme:
+        return url
+    return '%s/%s/%s' % (mock_server.rstrip('/'), parts.scheme, url[len(parts.scheme) + 3:])
+
+
+def from_mock_url(url, mock_server):
+    if not mock_server:
+        return url
+    prefix = mock_server.rstrip('/') + '/'
+    if not url.startswith(prefix):
+        return url
+    (scheme, rest) = url[len(prefix):].split('/', 1)
+    return '%s://%s' % (scheme, rest)
@@ -0,0 +1,190 @@
+import argparse
+import json
+import tracemalloc
+
+from serp_fixtures import *
+
+# 用fixtures目录下保存的搜索结果页测试每个搜索引擎解析页面的速度，和保存的基准结果比较，解析变慢了可以在发布之前发现
+# 不同机器的速度不一样，比较的是相对速度：同一次测试里面和只用BeautifulSoup构建同样的页面相比的速度
+# python parser-bench.py          测试并且和基准结果比较
+# python parser-bench.py --check  测试并且和基准结果比较，有变慢或者出错变多的就返回1（发布之前用）
+# python parser-bench.py --save   测试并且把结果保存为新的基准结果
+BASELINE_FILE = os.path.join(FIXTURE_DIR, 'benchmark-baseline.json')
+# get_url可能还要请求跳转页，所以测试的是不需要联网的get_link_url
+BS4_METHODS = ('BeautifulSoup', 'is_forbid', 'get_all_item', 'get_link_url', 'get_title', 'has_next_page',
+               'has_no_result')
+LXML_METHODS = ('get_tree', 'lxml_is_forbid', 'lxml_get_all_item', 'lxml_get_link_url', 'lxml_get_title',
+                'lxml_has_next_page', 'lxml_has_no_result')
+
+
+# 实际查询的时候出错了也不影响其他条目的方法（parse_items和safe_has_no_result里面捕获了异常），其他方法出错直接结束测试
+ALLOW_ERROR_METHODS = ('get_link_url', 'get_title', 'has_no_result',
+                       'lxml_get_link_url', 'lxml_get_title', 'lxml_has_no_result')
+
+
+class Timer:
+    """记录每个方法的调用次数和总用时，出错的调用不算用时，单独计数，免得解析坏了反而显得更快"""
+
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.errors = {}
+
+    def call(self, name, func, *args):
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except Exception:
+            if name not in ALLOW_ERROR_METHODS:
+                raise
+            self.errors[name] = self.errors.get(name, 0) + 1
+            return None
+        self.times[name] = self.times.get(name, 0) + time.perf_counter() - start
+        self.counts[name] = self.counts.get(name, 0) + 1
+        return result
+
+    # 每个方法平均每次调用的用时（微秒）
+    def get_latency(self):
+        return {name: self.times[name] / self.counts[name] * 1e6 for name in self.times.keys()}
+
+
+def run_bs4(ruler, r, timer):
+    soup = timer.call('BeautifulSoup', BeautifulSoup, r.text, 'lxml')
+    if timer.call('is_forbid', ruler.is_forbid, r, soup):
+        return
+    items = timer.call('get_all_item', ruler.get_all_item, soup) or []
+    for item in items:
+        timer.call('get_link_url', ruler.get_link_url, item, r.url)
+        timer.call('get_title', ruler.get_title, item)
+    timer.call('has_next_page', ruler.has_next_page, soup)
+    timer.call('has_no_result', ruler.has_no_result, soup)
+
+
+# 只构建BeautifulSoup，不调用ruler的方法，用来换算相对速度
+def run_reference(ruler, r, timer):
+    timer.call('BeautifulSoup', BeautifulSoup, r.text, 'lxml')
+
+
+def run_lxml(ruler, r, timer):
+    tree = timer.call('get_tree', get_tree, r.text)
+    if timer.call('lxml_is_forbid', ruler.lxml_is_forbid, r, tree):
+        return
+    items = timer.call('lxml_get_all_item', ruler.lxml_get_all_item, tree) or []
+    for item in items:
+        timer.call('lxml_get_link_url', ruler.lxml_get_link_url, item, r.url)
+        timer.call('lxml_get_title', ruler.lxml_get_title, item)
+    timer.call('lxml_has_next_page', ruler.lxml_has_next_page, tree)
+    timer.call('lxml_has_no_result', ruler.lxml_has_no_result, tree)
+
+
+# 返回每秒解析的页数、相对速度（和reference_speed相比）、每页解析完之后没有释放的内存块数量和峰值内存（KB）、
+# 每页出错的次数、每个方法的平均用时
+def bench(ruler, pages, run, min_time, repeat, reference_speed):
+    timer = Timer()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    for r in pages:
+        run(ruler, r, timer)
+    after = tracemalloc.take_snapshot()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    # 内存统计会让速度变慢，所以重新计时
+    (pages_per_second, best_timer) = measure_speed(ruler, pages, run, min_time, repeat)
+    return {
+        'pages_per_second': pages_per_second,
+        'relative_speed': pages_per_second / reference_speed,
+        'blocks_per_page': blocks / len(pages),
+        'peak_kb_per_page': peak / 1024 / len(pages),
+        'errors_per_page': sum(timer.errors.values()) / len(pages),
+        'latency_us': best_timer.get_latency(),
+    }
+
+
+# 计时重复repeat次取最快的一次，减少机器上其他程序的干扰，返回(每秒解析的页数, 最快那次的Timer)
+def measure_speed(ruler, pages, run, min_time, repeat):
+    best = None
+    for _ in range(repeat):
+        timer = Timer()
+        count = 0
+        start = time.perf_counter()
+        while count == 0 or time.perf_counter() - start < min_time:
+            for r in pages:
+                run(ruler, r, timer)
+            count += len(pages)
+        pages_per_second = count / (time.perf_counter() - start)
+        if best is None or pages_per_second > best[0]:
+            best = (pages_per_second, timer)
+    return best
+
+
+def run_all(min_time, repeat):
+    results = {}
+    for ruler_class in RULER_LIST:
+        ruler = ruler_class(None)
+        pages = [read_fixture(path) for path in get_fixtures(ruler_class)]
+        if len(pages) == 0:
+            print('%s没有保存的页面，跳过' % ruler_class.__name__)
+            continue
+        (reference_speed, _) = measure_speed(ruler, pages, run_reference, min_time, repeat)
+        results['%s/bs4' % ruler_class.__name__] = bench(ruler, pages, run_bs4, min_time, repeat, reference_speed)
+        if ruler.support_lxml:
+            results['%s/lxml' % ruler_class.__name__] = bench(ruler, pages, run_lxml, min_time, repeat,
+                                                             reference_speed)
+    return results
+
+
+def print_results(results, baseline, threshold):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        compare = ''
+        if base and 'relative_speed' in base:
+            ratio = base['relative_speed'] / result['relative_speed']
+            compare = '，是基准的%.2f倍用时' % ratio
+            if ratio > threshold:
+                regressions.append(name)
+                compare += '（变慢了）'
+            if result['errors_per_page'] > base['errors_per_page']:
+                regressions.append(name)
+                compare += '（出错变多了，基准每页出错%.2f次）' % base['errors_per_page']
+        print('%s：每秒%.0f页，相对速度%.3f，每页没有释放的内存块%.0f个，峰值内存%.1fKB，每页出错%.2f次%s'
+              % (name, result['pages_per_second'], result['relative_speed'], result['blocks_per_page'],
+                 result['peak_kb_per_page'], result['errors_per_page'], compare))
+        for method, latency in result['latency_us'].items():
+            base_latency = base and base['latency_us'].get(method)
+            if base_latency:
+                print('    %-20s %9.2f微秒（基准%.2f微秒）' % (method, latency, base_latency))
+            else:
+                print('    %-20s %9.2f微秒' % (method, latency))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--save', action='store_true', help='把这次的结果保存为基准结果')
+    parser.add_argument('--check', action='store_true', help='有变慢或者出错变多的就返回1')
+    parser.add_argument('--min-time', type=float, default=0.3, help='每次计时至少测试多少秒')
+    parser.add_argument('--repeat', type=int, default=3, help='每个搜索引擎每种解析方式计时几次，取最快的一次')
+    parser.add_argument('--threshold', type=float, default=1.3, help='用时超过基准的多少倍算变慢')
+    args = parser.parse_args()
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, encoding='utf-8') as f:
+            baseline = json.load(f)
+    results = run_all(args.min_time, args.repeat)
+    regressions = print_results(results, baseline, args.threshold)
+    if args.save:
+        with open(BASELINE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2, sort_keys=True)
+        print('基准结果已经保存在 %s' % BASELINE_FILE)
+        return 0
+    if len(regressions) != 0:
+        print('和基准结果相比变慢了或者出错变多了：%s' % '，'.join(sorted(set(regressions))))
+        return 1 if args.check else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+from serp_fixtures import *
+
+# 用fixtures目录下保存的搜索结果页核对BeautifulSoup和lxml两种解析方式的结果是否完全一致
+
+
+# 返回(是否被判定为爬虫, 是否需要重新请求, 解析结果)，解析结果里面的错误信息只保留有没有出错
+def parse_by_bs4(ruler, r):
+    soup = BeautifulSoup(r.text, 'lxml')
+    if ruler.is_forbid(r, soup):
+        return True, False, None
+    items = ruler.get_all_item(soup)
+    retry = len(items) == 0 and bool(ruler.retry_page(soup))
+    return False, retry, normalize(ruler.parse_page(r, soup, items, 1))
+
+
+def parse_by_lxml(ruler, r):
+    tree = get_tree(r.text)
+    if ruler.lxml_is_forbid(r, tree):
+        return True, False, None
+    items = ruler.lxml_get_all_item(tree)
+    retry = len(items) == 0 and bool(ruler.lxml_retry_page(tree, items))
+    return False, retry, normalize(ruler.lxml_parse_page(r, tree, items, 1))
+
+
+def normalize(parsed):
+    return parsed._replace(items=[item._replace(error=item.error is not None) for item in parsed.items])
+
+
+def print_diff(bs4_result, lxml_result):
+    names = ('是否被判定为爬虫', '是否需要重新请求')
+    for name, a, b in zip(names, bs4_result, lxml_result):
+        if a != b:
+            print('  %s不一致：bs4=%s lxml=%s' % (name, a, b))
+    (bs4_page, lxml_page) = (bs4_result[2], lxml_result[2])
+    if bs4_page is None or lxml_page is None:
+        return
+    for field in ('has_next_page', 'next_page_url', 'has_no_result'):
+        if getattr(bs4_page, field) != getattr(lxml_page, field):
+            print('  %s不一致：bs4=%s lxml=%s' % (field, getattr(bs4_page, field), getattr(lxml_page, field)))
+    if len(bs4_page.items) != len(lxml_page.items):
+        print('  条目数量不一致：bs4=%s lxml=%s' % (len(bs4_page.items), len(lxml_page.items)))
+    for i, (a, b) in enumerate(zip(bs4_page.items, lxml_page.items)):
+        if a != b:
+            print('  第%s条不一致：\n    bs4 =%s\n    lxml=%s' % (i + 1, a, b))
+
+
+def main():
+    diff_count = 0
+    file_count = 0
+    for ruler_class in RULER_LIST:
+        ruler = ruler_class(None)
+        for path in get_fixtures(ruler_class):
+            file_count += 1
+            r = read_fixture(path)
+            bs4_result = parse_by_bs4(ruler, r)
+            lxml_result = parse_by_lxml(ruler, r)
+            if bs4_result == lxml_result:
+                print('一致 %s' % path)
+            else:
+                diff_count += 1
+                print('不一致 %s' % path)
+                print_diff(bs4_result, lxml_result)
+    print('总共核对了%s个页面，%s个页面结果不一致' % (file_count, diff_count))
+    return diff_count
+
+
+if __name__ == '__main__':
+    sys.exit(1 if main() else 0)
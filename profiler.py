@@ -0,0 +1,127 @@
+import cProfile
+import io
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+import unicodedata
+from contextlib import nullcontext
+
+CAPTURE_MODES = ('', 'cprofile', 'tracemalloc')
+# 没有开启的时候每个阶段都用同一个什么都不做的上下文，几乎没有开销
+NULL_PHASE = nullcontext()
+
+
+# 控制台里面中文占两个字符的宽度，按显示宽度补齐空格，表格才能对齐
+def pad(text, width):
+    display_width = sum(2 if unicodedata.east_asian_width(char) in 'WF' else 1 for char in text)
+    return text + ' ' * max(width - display_width, 1)
+
+
+class Phase:
+    def __init__(self, profiler, engine, name):
+        self.profiler = profiler
+        self.engine = engine
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add(self.engine, self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """查询慢的时候看时间花在哪里：请求页面、构建BeautifulSoup、查找结果条目、解析条目、匹配域名、请求真实地址、保存结果
+    开启之后每次查询结束输出每个搜索引擎每个阶段的耗时；capture可以额外用cProfile或者tracemalloc记录整次查询，
+    capture_rate是记录的概率（定时运行的时候不用每次都记录）
+    异步模式下多个关键词同时请求，各阶段的耗时加起来会超过实际用时"""
+
+    def __init__(self):
+        self.enabled = False
+        self.capture = ''
+        self.capture_rate = 1.0
+        self.lock = threading.Lock()
+        # (搜索引擎, 阶段) -> [次数, 总耗时]
+        self.totals = {}
+        self.profile = None
+        self.tracing = False
+        self.start_time = 0
+
+    def configure(self, enabled, capture, capture_rate):
+        if capture not in CAPTURE_MODES:
+            raise ValueError('未知的性能分析方式：%s' % capture)
+        self.enabled = enabled
+        self.capture = capture
+        self.capture_rate = capture_rate
+
+    def phase(self, engine, name):
+        if not self.enabled:
+            return NULL_PHASE
+        return Phase(self, engine, name)
+
+    def add(self, engine, name, seconds):
+        with self.lock:
+            total = self.totals.setdefault((engine, name), [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+
+    def begin_run(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.totals = {}
+        self.start_time = time.perf_counter()
+        if self.capture == '' or random.random() >= self.capture_rate:
+            return
+        if self.capture == 'cprofile':
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        else:
+            tracemalloc.start()
+            self.tracing = True
+
+    # name用在记录文件的文件名里面
+    def end_run(self, name):
+        if not self.enabled:
+            return
+        print(self.format_summary(time.perf_counter() - self.start_time))
+        if self.profile is not None:
+            self.profile.disable()
+            file_name = '性能分析-%s.prof' % name
+            self.profile.dump_stats(file_name)
+            output = io.StringIO()
+            pstats.Stats(self.profile, stream=output).sort_stats('cumulative').print_stats(50)
+            with open('性能分析-%s.txt' % name, 'w', encoding='utf-8') as f:
+                f.write(output.getvalue())
+            self.profile = None
+            print('cProfile记录保存在 %s' % file_name)
+        if self.tracing:
+            snapshot = tracemalloc.take_snapshot()
+            (current, peak) = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.tracing = False
+            file_name = '内存分析-%s.txt' % name
+            with open(file_name, 'w', encoding='utf-8') as f:
+                f.write('当前%.1fMB，峰值%.1fMB\n' % (current / 1024 / 1024, peak / 1024 / 1024))
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write('%s\n' % stat)
+            print('tracemalloc记录保存在 %s' % file_name)
+
+    def format_summary(self, elapsed):
+        with self.lock:
+            totals = sorted(self.totals.items(), key=lambda item: (item[0][0], -item[1][1]))
+        lines = ['各阶段耗时（总用时%.1f秒）：' % elapsed,
+                 pad('搜索引擎', 12) + pad('阶段', 22) + pad('次数', 10) + pad('总耗时(秒)', 12) + pad('平均(毫秒)', 12) + '占比']
+        for ((engine, name), (count, seconds)) in totals:
+            lines.append(pad(engine, 12) + pad(name, 22) + pad(str(count), 10) + pad('%.2f' % seconds, 12)
+                         + pad('%.2f' % (seconds / count * 1000), 12)
+                         + '%.1f%%' % (seconds / elapsed * 100 if elapsed > 0 else 0))
+        return '\n'.join(lines)
+
+
+PROFILER = Profiler()
@@ -0,0 +1,96 @@
+import random
+import threading
+import time
+
+# 请求搜索引擎用的代理池，被判定为爬虫的时候只暂停那一个代理，其他代理继续查询，不用整个搜索引擎都停下来等
+# config.ini里面填proxy_list = http://1.2.3.4:8080, http://5.6.7.8:3128, direct
+# direct表示不用代理直接请求，异步模式（aiohttp）只支持http代理
+DIRECT = 'direct'
+# 健康分数的范围，选择代理的概率和分数成正比，分数再低也有一点机会被选到，这样恢复了的代理可以慢慢加回来
+MIN_SCORE = 0.05
+MAX_SCORE = 1.0
+
+
+def parse_proxy_list(text):
+    return [proxy.strip() for proxy in text.replace('，', ',').split(',') if proxy.strip()]
+
+
+class ProxyPool:
+    """每个代理对每个搜索引擎有自己的健康分数和暂停时间：请求成功分数上升，网络错误分数下降，
+    被判定为爬虫的时候分数下降并且暂停cooldown秒，选择代理的时候在没有暂停的代理里面按分数加权随机选择
+    没有配置代理的时候choose总是返回None，和原来一样直接请求"""
+
+    def __init__(self, proxies, cooldown, seed=None):
+        self.proxies = list(proxies)
+        self.cooldown = cooldown
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # (代理, 搜索引擎) -> 分数 / 暂停到什么时候
+        self.scores = {}
+        self.resume_times = {}
+
+    @property
+    def enabled(self):
+        return len(self.proxies) != 0
+
+    def get_score(self, proxy, engine):
+        return self.scores.get((proxy, engine), MAX_SCORE)
+
+    def is_cooling(self, proxy, engine, now):
+        return self.resume_times.get((proxy, engine), 0) > now
+
+    # 返回代理的地址，直接请求的时候返回None；所有代理都在暂停的时候也返回None，调用的地方先用get_wait_time等一下
+    def choose(self, engine):
+        if not self.enabled:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            available = [proxy for proxy in self.proxies if not self.is_cooling(proxy, engine, now)]
+            if len(available) == 0:
+                return None
+            weights = [self.get_score(proxy, engine) for proxy in available]
+            return self.random.choices(available, weights)[0]
+
+    # 还要等多少秒才有代理可以用，0就是现在就有
+    def get_wait_time(self, engine):
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        with self.lock:
+            return max(min(self.resume_times.get((proxy, engine), 0) for proxy in self.proxies) - now, 0)
+
+    def report_success(self, proxy, engine):
+        self.update_score(proxy, engine, lambda score: score * 0.8 + 0.2)
+
+    def report_failure(self, proxy, engine):
+        self.update_score(proxy, engine, lambda score: score * 0.5)
+
+    def report_forbid(self, proxy, engine):
+        self.update_score(proxy, engine, lambda score: score * 0.5)
+        if proxy is not None:
+            with self.lock:
+                self.resume_times[(proxy, engine)] = time.monotonic() + self.cooldown
+
+    def update_score(self, proxy, engine, update):
+        if proxy is None:
+            return
+        with self.lock:
+            score = update(self.get_score(proxy, engine))
+            self.scores[(proxy, engine)] = min(max(score, MIN_SCORE), MAX_SCORE)
+
+    def describe(self, proxy):
+        return '直接请求' if proxy == DIRECT else '代理%s' % proxy
+
+
+# requests用的proxies参数
+def to_requests_proxies(proxy):
+    if proxy is None or proxy == DIRECT:
+        return None
+    return {'http': proxy, 'https': proxy}
+
+
+# aiohttp用的proxy参数
+def to_aiohttp_proxy(proxy):
+    if proxy is None or proxy == DIRECT:
+        return None
+    return proxy
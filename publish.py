@@ -27,7 +27,7 @@ def sp():
 
 
 def status_spider():
-    os.system('pyinstaller -F status-spider/spider.py')
+    os.system('pyinstaller -F --paths . status-spider/spider.py')
     zipf = zipfile.ZipFile('状态查询.zip', 'w')
     zipf.write('./status-spider/config.ini', 'config.ini')
     zipf.write('./status-spider/import/import.xlsx', 'import/import.xlsx')
@@ -0,0 +1,43 @@
+import json
+import os
+
+HISTORY_DIR = '排名记录'
+
+
+class RankHistory:
+    """一个搜索引擎上次查询每个关键词的时候每个域名最早出现在第几页，用来决定这次查到第几页就可以停下来"""
+
+    def __init__(self, engine_name):
+        self.path = os.path.join(HISTORY_DIR, '%s.json' % engine_name)
+        # str(keyword) -> {domain: page}，JSON的键只能是字符串，从xlsx读到的数字关键词（例如2013）也按字符串存取
+        self.keywords = {}
+        self.changed = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.keywords = json.load(f)
+        except ValueError:
+            # 文件损坏的时候当成没有记录，这次全部查询完整的页数
+            self.keywords = {}
+
+    # 上次查到的域名和所在的页数，上次没有查到任何域名（或者没有查过）的关键词返回None
+    def get(self, keyword):
+        return self.keywords.get(str(keyword)) or None
+
+    def update(self, keyword, domain_pages):
+        self.keywords[str(keyword)] = dict(domain_pages)
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.keywords, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+        self.changed = False
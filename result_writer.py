@@ -0,0 +1,118 @@
+import csv
+import os
+
+from openpyxl import Workbook
+
+RESULT_FORMATS = ('xlsx', 'csv')
+
+
+class ResultWriter:
+    """查到一条结果就写一条，不用等全部查询完再一次性保存
+    xlsx用openpyxl的write_only模式，内存占用不会随着结果增加；csv每写一行都会写到磁盘，程序中断也不会丢失已经查到的结果
+    xlsx只有在close的时候才会写到磁盘，所以查询过程中同时写一份同名的.未完成.csv，程序中途被强行结束的时候已经查到的结果在这个文件里面，
+    xlsx保存好了之后删掉"""
+
+    def __init__(self, name, header, result_format):
+        if result_format not in RESULT_FORMATS:
+            raise ValueError('未知的结果文件格式：%s' % result_format)
+        self.file_name = '%s.%s' % (name, result_format)
+        self.partial_file_name = '%s.未完成.csv' % name
+        self.header = header
+        self.result_format = result_format
+        self.file = None
+        self.writer = None
+        self.workbook = None
+        self.sheets = {}
+
+    @property
+    def opened(self):
+        return self.file is not None or self.workbook is not None
+
+    def open(self):
+        if self.opened:
+            return
+        if self.result_format == 'csv':
+            self.open_csv(self.file_name)
+        else:
+            self.workbook = Workbook(write_only=True)
+            self.open_csv(self.partial_file_name)
+
+    def open_csv(self, file_name):
+        # 带BOM的utf-8，用Excel直接打开不会乱码
+        self.file = open(file_name, 'w', newline='', encoding='utf-8-sig')
+        self.writer = csv.writer(self.file)
+        if self.header:
+            self.write_row(self.header)
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def get_sheet(self, sheet_name):
+        if sheet_name not in self.sheets:
+            if sheet_name is None:
+                ws = self.workbook.create_sheet()
+                if self.header:
+                    ws.append(self.header)
+            else:
+                # 和原来一样，后查询的排在前面
+                ws = self.workbook.create_sheet(sheet_name, 0)
+            self.sheets[sheet_name] = ws
+        return self.sheets[sheet_name]
+
+    # xlsx每个sheet_name一个工作表，csv没有工作表，sheet_name写在第一列
+    def add_sheet(self, sheet_name):
+        self.open()
+        if self.workbook is not None:
+            self.get_sheet(sheet_name)
+
+    def append(self, row, sheet_name=None):
+        self.open()
+        if self.workbook is not None:
+            self.get_sheet(sheet_name).append(row)
+        if sheet_name is None:
+            self.write_row(row)
+        else:
+            self.write_row((sheet_name,) + tuple(row))
+
+    # 一条结果都没有写过的就不生成文件，返回None
+    def close(self):
+        file_name = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            file_name = self.file_name
+        if self.workbook is not None:
+            if len(self.sheets) == 0:
+                self.get_sheet(None)
+            self.workbook.save(self.file_name)
+            self.workbook = None
+            self.sheets = {}
+            os.remove(self.partial_file_name)
+            file_name = self.file_name
+        return file_name
+
+
+class ErrorLog:
+    """查询过程中产生的错误，出现一个就追加一个到日志文件，没有错误就不生成文件"""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.file = None
+        self.count = 0
+
+    def append(self, error):
+        if self.file is None:
+            self.file = open(self.file_name, 'w', encoding='utf-8')
+        if self.count != 0:
+            self.file.write('\n\n')
+        self.file.write(error)
+        self.file.flush()
+        self.count += 1
+
+    def close(self):
+        if self.file is None:
+            return None
+        self.file.close()
+        self.file = None
+        return self.file_name
@@ -1,7 +1 @@
-start all-spider.exe 0 0 0
-start all-spider.exe 0 1 0
-start all-spider.exe 0 2 0
-start all-spider.exe 0 3 0
-start all-spider.exe 0 4 0
-start all-spider.exe 0 5 0
-start all-spider.exe 0 6 0
+start all-spider.exe 0 7 0
@@ -0,0 +1,28 @@
+import os
+
+from spider import *
+
+# fixtures/<ruler类名>/*.html，第一行是请求的URL，后面是页面内容（和“新型爬虫返回页”文件的格式一样）
+FIXTURE_DIR = 'fixtures'
+RULER_LIST = (
+    SMRuler,
+    SogouPCRuler,
+    SogouMobileRuler,
+    BaiduPCRuler,
+    BaiduMobileRuler,
+    SLLPCRuler,
+    SLLMobileRuler,
+)
+
+
+def read_fixture(path):
+    with open(path, encoding='utf-8') as f:
+        url = f.readline().strip()
+        return Response(url, 200, {}, f.read())
+
+
+def get_fixtures(ruler_class):
+    path = os.path.join(FIXTURE_DIR, ruler_class.__name__)
+    if not os.path.isdir(path):
+        return []
+    return [os.path.join(path, file) for file in sorted(os.listdir(path)) if file.endswith('.html')]
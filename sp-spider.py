@@ -1,6 +1,9 @@
 from spider import *
+import multiprocessing
 
 if __name__ == '__main__':
+    # 打包成exe之后 解析进程需要这个才能正常启动
+    multiprocessing.freeze_support()
     engine_list = [
         (BaiduPCRuler, '百度PC'),
         (BaiduMobileRuler, '百度MOBILE')
@@ -1,25 +1,75 @@
 import ast
+import asyncio
+import contextvars
+import json
 import os
+import random
 import re
 import sys
 import time
 import traceback
 from abc import ABCMeta, abstractmethod
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from configparser import ConfigParser
 from datetime import datetime
+from http.cookiejar import DefaultCookiePolicy
 from urllib.parse import urlparse, parse_qsl, urlsplit, urljoin
 
+import aiohttp
 import requests
 from bs4 import BeautifulSoup, Comment
-from openpyxl import load_workbook, Workbook
+from checkpoint import CrawlJournal
+from input_reader import list_input_files, read_rows, input_cache
+from mock_transport import to_mock_url, from_mock_url
+from rank_history import RankHistory
+from proxy_pool import ProxyPool, parse_proxy_list, to_requests_proxies, to_aiohttp_proxy
+from disk_cache import open_disk_cache
+from metrics import METRICS
+from profiler import PROFILER
+from work_queue import open_work_queue
+from lxml import etree
+from lxml.html import HTMLParser, document_fromstring
+from openpyxl import Workbook
+from result_writer import ResultWriter, ErrorLog
 
 # import this seems unused
 # but it's to prevent 'bs4.FeatureNotFound: Couldn't find a tree builder with the features you requested: lxml.'
 import lxml
+# import this seems unused but it's to prevent 'LookupError: unknown encoding: idna'
+import encodings.idna
 
 page_cfg = ConfigParser()
 page_cfg.read('config.ini')
 PAGE = int(page_cfg.get('config', 'page_count'))
+# 普通模式下每页的结果数，page_count和结果里面的页数、排名都是按这个算的
+DEFAULT_PAGE_SIZE = 10
+PARSE_BACKEND = page_cfg.get('config', 'parse_backend')
+RESULT_FORMAT = page_cfg.get('config', 'result_format')
+MOCK_SERVER = page_cfg.get('config', 'mock_server').strip()
+PROFILER.configure(page_cfg.get('config', 'profile') == '1', page_cfg.get('config', 'profile_capture').strip(),
+                   float(page_cfg.get('config', 'profile_capture_rate')))
+# 所有搜索引擎共用一个代理池，每个代理对每个搜索引擎分别计算健康分数
+PROXY_POOL = ProxyPool(parse_proxy_list(page_cfg.get('config', 'proxy_list')),
+                       float(page_cfg.get('config', 'proxy_cooldown')))
+RANK_HEADER = ('域名', '关键词', '搜索引擎', '页数', '排名', '真实地址', '标题', '查询时间')
+UNSAFE_HEADER = ('关键词', '是否空白', '安全提醒', '页数', '排名')
+# 请求跳转链接的超时时间(单位：秒)，超时了当成网络断开重新请求
+RESOLVE_TIMEOUT = 10
+# 分布式查询的时候多久检查一次任务数据库(单位：秒)
+UNIT_POLL_INTERVAL = 10
+# Windows控制台标题显示的查询进度最多多久更新一次(单位：秒)，每次更新都要启动一个进程
+TITLE_INTERVAL = 5
+# 同时请求好几页查收录的时候最多查到第几页，搜索引擎一般最多只给出七十多页结果
+SITE_MAX_PAGE = 100
+# 每一条结果的真实地址是怎么拿到的，查询结束的时候输出每种的次数
+URL_SOURCES = {
+    'page': '页面上的链接',
+    'markup': '页面标记里面的真实地址',
+    'cache': '跳转链接缓存',
+    'skip': '显示的域名不符合，没有请求',
+    'request': '请求跳转链接',
+}
 
 
 def get_cur_time_filename():
@@ -32,25 +82,230 @@ def format_cd_time(seconds):
     return "%d小时%02d分%02d秒" % (h, m, s)
 
 
-def is_list_include_another_list(child_list, parent_list):
-    if child_list[0] in parent_list:
-        index = parent_list.index(child_list[0])
-        for i, child in enumerate(child_list):
-            if child not in parent_list or parent_list.index(child) != index + i:
-                return False
-        return True
-    else:
-        return False
+class DomainMatcher:
+    """把要查的域名按'.'分割成标签序列放进字典，判断网址属于哪个域名的时候只要查网址标签序列的连续片段，
+    不用再把网址和每个域名逐一比较，域名再多每个网址也只要查几次字典"""
+
+    def __init__(self, domain_set):
+        self.domains = {}
+        self.match_all = False
+        for domain in domain_set:
+            if domain == '*':
+                self.match_all = True
+            elif domain is not None:
+                self.domains[tuple(domain.split('.'))] = domain
+        self.max_length = max((len(labels) for labels in self.domains.keys()), default=0)
+
+    # 返回网址所属的域名，没有就返回None
+    # 和原来一样，域名是网址的一段连续的标签就算符合，有多个域名符合的时候返回标签最多的那个，都不符合才算是'*'
+    def match(self, netloc):
+        labels = netloc.split('.')
+        for length in range(min(len(labels), self.max_length), 0, -1):
+            for start in range(len(labels) - length + 1):
+                domain = self.domains.get(tuple(labels[start:start + length]))
+                if domain is not None:
+                    return domain
+        return '*' if self.match_all else None
+
+    def tracks(self, domain):
+        return domain in self.domains.values() or (domain == '*' and self.match_all)
+
+    # found里面是不是已经包括了所有要查的域名，有'*'的时候永远不算全部找到
+    def is_all_found(self, found):
+        return not self.match_all and len(self.domains) != 0 and all(
+            domain in found for domain in self.domains.values())
+
+
+# 不是一对一模式的时候所有关键词共用同一个域名集合，同一个集合只编译一次
+def compile_keyword_domains_map(keyword_domains_map):
+    matchers = {}
+    keyword_matcher_map = {}
+    for keyword, domain_set in keyword_domains_map.items():
+        if id(domain_set) not in matchers:
+            matchers[id(domain_set)] = DomainMatcher(domain_set)
+        keyword_matcher_map[keyword] = matchers[id(domain_set)]
+    return keyword_matcher_map
+
+
+# 页面上显示的网址里面的域名，显示不完整（中间有省略号）或者显示的不是网址的时候返回None
+def get_show_domain(show_url):
+    if not show_url:
+        return None
+    show_url = show_url.strip().lower()
+    if '://' in show_url:
+        show_url = show_url.split('://', 1)[1]
+    domain = re.split(r'[/\s?#]', show_url, 1)[0]
+    if not re.fullmatch(r'[a-z0-9-]+(\.[a-z0-9-]+)+', domain):
+        return None
+    return domain
 
 
 def page_has_text(soup, text):
     return soup.find(text=re.compile(text))
 
 
+def has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+
+def xpath(expr):
+    return etree.XPath(expr, smart_strings=False)
+
+
+lxml_parser = HTMLParser(encoding='utf-8')
+
+
+def get_tree(text):
+    # 先转成bytes 带有<?xml encoding=...?>声明的页面直接用str解析的话lxml会报错
+    try:
+        return document_fromstring(text.encode('utf-8'), parser=lxml_parser)
+    except etree.ParserError:
+        # 空白页面 和BeautifulSoup一样当成一个什么都没有的文档
+        return etree.Element('html')
+
+
+# 和BeautifulSoup的findAll(text=...)一样 把元素里面所有的文字拼起来
+def get_text(element, with_comment=False):
+    if with_comment:
+        return ''.join(node if isinstance(node, str) else (node.text or '')
+                       for node in element.xpath('.//text() | .//comment()'))
+    else:
+        return ''.join(element.xpath('.//text()'))
+
+
+# 和BeautifulSoup里面Tag.string一样 只有一个子节点的时候才有值
+def get_string(element):
+    if len(element) == 0:
+        return element.text
+    elif len(element) == 1 and not element.text and not element[0].tail:
+        return get_string(element[0])
+    else:
+        return None
+
+
+def first_string(element):
+    nodes = element.xpath('(.//text() | .//comment())[1]')
+    if nodes:
+        return nodes[0] if isinstance(nodes[0], str) else nodes[0].text
+
+
+def tree_has_text(tree, text):
+    pattern = re.compile(text)
+    for node in tree.xpath('//text() | //comment()'):
+        if pattern.search(node if isinstance(node, str) else (node.text or '')):
+            return True
+    return False
+
+
 class MyError(RuntimeError):
     pass
 
 
+PAGE_OK, PAGE_FORBID, PAGE_ABNORMAL = range(3)
+
+# 异步模式下每个关键词都在自己的task里面跑，当前关键词的session、关键词、页数放在这里，ruler里面嵌套请求的时候也能拿到
+current_session = contextvars.ContextVar('current_session')
+current_keyword = contextvars.ContextVar('current_keyword', default='')
+current_page = contextvars.ContextVar('current_page', default=0)
+
+
+# 解析页面得到的结果，只包含后面需要用到的数据，可以在解析进程和请求进程之间传递
+# link_url是页面上的地址，need_request为True的时候还需要再请求一次才能拿到真实地址
+# show_url是页面上显示的网址，只用来判断需不需要请求真实地址，没有就是None
+# url_source是地址从哪里来的，见URL_SOURCES
+ParsedItem = namedtuple('ParsedItem', ('link_url', 'need_request', 'title', 'unsafe', 'error', 'show_url',
+                                       'url_source'))
+ParsedPage = namedtuple('ParsedPage', ('items', 'has_next_page', 'next_page_url', 'has_no_result'))
+
+
+class Response:
+    """把aiohttp的返回整理成和requests.Response一样的用法，这样ruler里面的r.url、r.text可以直接复用"""
+
+    def __init__(self, url, status_code, headers, text):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+
+class RateController:
+    """每个搜索引擎一个，自动调整请求速度（AIMD）：页面正常的时候每次加快一点，被判定为爬虫或者页面异常的时候速度减半，
+    并且按连续出错的次数成倍地暂停（加上随机的浮动，避免所有关键词同时重新请求）
+    填了request_interval_time的时候最快也只到这个间隔，不会比手动设置的速度更快
+    关闭了adaptive_rate的时候和原来一样：固定的request_interval_time，出错的时候固定等待error_interval_time"""
+
+    # 请求间隔填0的时候最快每秒请求多少次
+    MAX_RATE = 20
+
+    def __init__(self, ruler, cfg):
+        self.ruler = ruler
+        self.adaptive = cfg.get('config', 'adaptive_rate') == '1'
+        self.error_interval_time = float(cfg.get('config', 'error_interval_time'))
+        self.max_error_interval_time = float(cfg.get('config', 'max_error_interval_time'))
+        self.rate_increase = float(cfg.get('config', 'rate_increase'))
+        min_interval = float(cfg.get('config', 'min_request_interval_time'))
+        self.max_rate = 1 / min_interval if min_interval > 0 else self.MAX_RATE
+        interval = ruler.request_interval_time
+        if interval > 0:
+            self.max_rate = min(1 / interval, self.max_rate)
+        # max_error_interval_time填0（出错不等待）的时候最慢也是每秒一次
+        self.min_rate = 1 / max(self.max_error_interval_time, 1)
+        self.rate = self.max_rate
+        self.error_count = 0
+
+    # 当前两次请求之间的间隔（秒）
+    @property
+    def interval(self):
+        if not self.adaptive:
+            return self.ruler.request_interval_time
+        return 1 / self.rate
+
+    def on_success(self):
+        self.error_count = 0
+        if self.adaptive:
+            self.rate = min(self.rate + self.rate_increase, self.max_rate)
+
+    # 被判定为爬虫或者页面异常，返回要暂停多少秒
+    def back_off(self):
+        if not self.adaptive:
+            return self.error_interval_time
+        self.error_count += 1
+        self.rate = max(self.rate / 2, self.min_rate)
+        wait_time = min(self.error_interval_time * 2 ** (self.error_count - 1), self.max_error_interval_time)
+        return wait_time * random.uniform(0.5, 1.5)
+
+    def describe(self):
+        return '每秒%.2f次' % (1 / self.interval) if self.interval > 0 else '不限速度'
+
+
+class RateLimiter:
+    """异步模式下同一个搜索引擎的所有请求共用一个，保证两次请求之间的间隔不小于RateController当前的间隔"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.lock = asyncio.Lock()
+        self.last_request_time = 0
+        self.resume_time = 0
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            next_time = max(self.last_request_time + self.controller.interval, self.resume_time)
+            if next_time > now:
+                await asyncio.sleep(next_time - now)
+            self.last_request_time = time.monotonic()
+
+    # 跳转链接不是搜索结果页，不用等请求间隔，只有整个搜索引擎暂停的时候要等
+    async def wait_resume(self):
+        now = time.monotonic()
+        if self.resume_time > now:
+            await asyncio.sleep(self.resume_time - now)
+
+    # 被判定为爬虫的时候 整个搜索引擎都要暂停 而不是只有当前的关键词暂停
+    def pause(self, seconds):
+        self.resume_time = max(self.resume_time, time.monotonic() + seconds)
+
+
 class SpiderRuler(metaclass=ABCMeta):
     def __init__(self, spider):
         self.spider = spider
@@ -75,6 +330,13 @@ class SpiderRuler(metaclass=ABCMeta):
     def request_interval_time(self):
         pass
 
+    # 一次请求多少条结果，开启large_page的时候由RankSpider设置，page是按这个大小算的第几次请求
+    page_size = DEFAULT_PAGE_SIZE
+    # 搜索引擎支持的每页最多结果数，不支持修改的就是DEFAULT_PAGE_SIZE
+    max_page_size = DEFAULT_PAGE_SIZE
+    # get_params可以直接拼出任意一页的地址，不用按照上一页的下一页链接翻页，异步模式下可以同时请求好几页
+    direct_paging = False
+
     @abstractmethod
     def get_params(self, keyword, page):
         pass
@@ -90,6 +352,27 @@ class SpiderRuler(metaclass=ABCMeta):
     def get_url(self, item, page_url):
         pass
 
+    # 返回(地址, 是否还需要请求这个地址才能拿到真实地址)，需要额外请求才能拿到真实地址的ruler要重写这个方法
+    def get_link_url(self, item, page_url):
+        return self.get_url(item, page_url), False
+
+    def resolve_url(self, url):
+        return url
+
+    async def async_resolve_url(self, url):
+        return url
+
+    # 为True的时候一页里面需要请求真实地址的条目同时请求，而不是一个一个请求
+    concurrent_resolve = False
+
+    # 页面上显示的网址，有的话显示的域名不符合要查的域名的条目就不用再请求真实地址
+    def get_show_url(self, item):
+        return None
+
+    # 条目的标记里面直接带着的真实地址，get_link_url返回的地址需要请求的时候才会用到，有的话就不用再请求了
+    def get_landing_url(self, item):
+        return None
+
     @abstractmethod
     def get_title(self, item):
         pass
@@ -116,6 +399,151 @@ class SpiderRuler(metaclass=ABCMeta):
     def is_unsafe(self, item):
         return False
 
+    # 把页面里面需要的数据都取出来，这样后面就不需要再用到soup了，可以放到单独的解析进程里面执行
+    def parse_page(self, r, soup, items, page):
+        parsed_items = self.parse_items(items, r.url, self.get_link_url, self.get_title, self.is_unsafe,
+                                        self.get_show_url, self.get_landing_url)
+        has_no_result = page == 1 and self.safe_has_no_result(self.has_no_result, soup)
+        return ParsedPage(parsed_items, bool(self.has_next_page(soup)), self.get_next_page_url(soup), has_no_result)
+
+    def parse_items(self, items, page_url, get_link_url, get_title, is_unsafe, get_show_url, get_landing_url):
+        parsed_items = []
+        for item in items:
+            try:
+                (link_url, need_request) = get_link_url(item, page_url)
+            except KeyboardInterrupt as e:
+                raise e
+            except:
+                parsed_items.append(ParsedItem(None, False, None, False, traceback.format_exc(), None, 'page'))
+                continue
+            try:
+                title = get_title(item)
+            except KeyboardInterrupt as e:
+                raise e
+            except:
+                title = None
+            url_source = 'page'
+            show_url = None
+            if need_request:
+                landing_url = self.safe_call(get_landing_url, item)
+                if landing_url:
+                    (link_url, need_request, url_source) = (landing_url, False, 'markup')
+                else:
+                    show_url = self.safe_call(get_show_url, item)
+            parsed_items.append(ParsedItem(link_url, need_request, title, bool(is_unsafe(item)), None, show_url,
+                                           url_source))
+        return parsed_items
+
+    # 只是用来少请求几次的数据，取不到就当成没有
+    @staticmethod
+    def safe_call(func, item):
+        try:
+            return func(item)
+        except KeyboardInterrupt as e:
+            raise e
+        except:
+            return None
+
+    @staticmethod
+    def safe_has_no_result(has_no_result, page):
+        try:
+            return bool(has_no_result(page))
+        except KeyboardInterrupt as e:
+            raise e
+        except:
+            return False
+
+    # lxml解析方式：ruler声明下面这些编译好的XPath，直接在lxml.html的树上取数据，不需要构造soup，比BeautifulSoup快很多
+    # 没有声明item_xpath的ruler不支持这种方式，还是用BeautifulSoup解析
+    item_xpath = None
+    # 条目里面标题所在的元素，没有声明就是条目本身
+    title_xpath = None
+    # 找不到标题元素的时候的标题，和BeautifulSoup方式下的结果保持一致
+    missing_title = None
+    title_with_comment = False
+    has_next_page_xpath = None
+    # 下一页的<a>，没有声明has_next_page_xpath的话 有这个元素就认为有下一页
+    next_page_xpath = None
+    forbid_xpath = None
+    forbid_urls = ()
+    forbid_texts = ()
+    # 全部都出现才认为是没有结果
+    no_result_texts = ()
+    unsafe_xpath = None
+    retry_xpath = None
+    show_url_xpath = None
+
+    @property
+    def support_lxml(self):
+        return self.item_xpath is not None
+
+    def lxml_is_forbid(self, r, tree):
+        return any(r.url.startswith(url) for url in self.forbid_urls) \
+               or (self.forbid_xpath is not None and self.forbid_xpath(tree)) \
+               or any(tree_has_text(tree, text) for text in self.forbid_texts)
+
+    def lxml_get_all_item(self, tree):
+        return self.item_xpath(tree)
+
+    # 大部分ruler的get_link_url只用到了item.get，lxml的元素也有同样的方法
+    def lxml_get_link_url(self, item, page_url):
+        return self.get_link_url(item, page_url)
+
+    def lxml_get_title(self, item):
+        if self.title_xpath is None:
+            element = item
+        else:
+            elements = self.title_xpath(item)
+            if not elements:
+                return self.missing_title
+            element = elements[0]
+        return get_text(element, self.title_with_comment)
+
+    def lxml_get_next_page_link(self, tree):
+        if self.next_page_xpath is not None:
+            links = self.next_page_xpath(tree)
+            if links:
+                return links[0]
+
+    def lxml_has_next_page(self, tree):
+        if self.has_next_page_xpath is not None:
+            return self.has_next_page_xpath(tree)
+        else:
+            return self.lxml_get_next_page_link(tree) is not None
+
+    def lxml_get_next_page_url(self, tree):
+        link = self.lxml_get_next_page_link(tree)
+        if link is not None:
+            href = link.get('href')
+            if href:
+                return urljoin(self.base_url, href)
+
+    def lxml_has_no_result(self, tree):
+        return len(self.no_result_texts) != 0 and all(tree_has_text(tree, text) for text in self.no_result_texts)
+
+    def lxml_is_unsafe(self, item):
+        return self.unsafe_xpath is not None and self.unsafe_xpath(item)
+
+    # 大部分ruler的get_landing_url只用到了item.get，lxml的元素也有同样的方法
+    def lxml_get_landing_url(self, item):
+        return self.get_landing_url(item)
+
+    def lxml_get_show_url(self, item):
+        if self.show_url_xpath is not None:
+            elements = self.show_url_xpath(item)
+            if elements:
+                return get_text(elements[0])
+
+    def lxml_retry_page(self, tree, items):
+        return self.retry_xpath is not None and self.retry_xpath(tree) and len(items) == 0
+
+    def lxml_parse_page(self, r, tree, items, page):
+        parsed_items = self.parse_items(items, r.url, self.lxml_get_link_url, self.lxml_get_title, self.lxml_is_unsafe,
+                                        self.lxml_get_show_url, self.lxml_get_landing_url)
+        has_no_result = page == 1 and self.safe_has_no_result(self.lxml_has_no_result, tree)
+        return ParsedPage(parsed_items, bool(self.lxml_has_next_page(tree)), self.lxml_get_next_page_url(tree),
+                          has_no_result)
+
 
 class SMRuler(SpiderRuler):
     def __init__(self, spider):
@@ -141,6 +569,8 @@ class SMRuler(SpiderRuler):
     def engine_name(self):
         return '神马'
 
+    direct_paging = True
+
     def get_params(self, keyword, page):
         return {
             'q': keyword,
@@ -171,6 +601,18 @@ class SMRuler(SpiderRuler):
     def has_no_result(self, soup):
         return page_has_text(soup, '1. 看看输入的文字是否有误') and page_has_text(soup, '2. 去掉可能不必要的字词，如"的"、"什么"等')
 
+    item_xpath = xpath('//div[%s]' % has_class('ali_row'))
+    link_xpath = xpath('(.//a)[1]')
+    title_xpath = link_xpath
+    title_with_comment = True
+    has_next_page_xpath = xpath('boolean(//a[%s])' % has_class('next'))
+    forbid_xpath = xpath("not(//body) or (//title)[1] = '验证码拦截'")
+    no_result_texts = ('1. 看看输入的文字是否有误', '2. 去掉可能不必要的字词，如"的"、"什么"等')
+
+    def lxml_get_link_url(self, item, page_url):
+        links = self.link_xpath(item)
+        return (links[0].get('href') if links else None), False
+
 
 class SogouPCRuler(SpiderRuler):
     def __init__(self, spider):
@@ -196,6 +638,8 @@ class SogouPCRuler(SpiderRuler):
     def engine_name(self):
         return '搜狗PC'
 
+    direct_paging = True
+
     def get_params(self, keyword, page):
         return {
             'query': keyword,
@@ -223,6 +667,26 @@ class SogouPCRuler(SpiderRuler):
     def has_no_result(self, soup):
         return soup.find('p', class_='num-tips', text=re.compile('.*?搜狗已为您找到约0条相关结果.*?'))
 
+    item_xpath = xpath('(//div[%s])[1]/div' % has_class('results'))
+    link_xpath = xpath('(.//a)[1]')
+    title_xpath = link_xpath
+    has_next_page_xpath = xpath("boolean(//*[@id='sogou_next'])")
+    forbid_urls = ('http://www.sogou.com/antispider',)
+    forbid_xpath = xpath('not(//div[%s])' % has_class('results'))
+    no_result_xpath = xpath('//p[%s]' % has_class('num-tips'))
+
+    def lxml_get_link_url(self, item, page_url):
+        links = self.link_xpath(item)
+        return (links[0].get('href') if links else None), False
+
+    def lxml_has_no_result(self, tree):
+        pattern = re.compile('.*?搜狗已为您找到约0条相关结果.*?')
+        for p in self.no_result_xpath(tree):
+            string = get_string(p)
+            if string is not None and pattern.search(string):
+                return True
+        return False
+
     # 开启的话 查找到第五页左右搜索引擎就会认为你是爬虫
     @property
     def enable_session(self):
@@ -253,6 +717,8 @@ class SogouMobileRuler(SpiderRuler):
     def engine_name(self):
         return '搜狗MOBILE'
 
+    direct_paging = True
+
     def get_params(self, keyword, page):
         return {
             'keyword': keyword,
@@ -269,31 +735,53 @@ class SogouMobileRuler(SpiderRuler):
         return items
 
     def get_url(self, item, page_url):
+        (url, need_request) = self.get_link_url(item, page_url)
+        if need_request:
+            return self.resolve_url(url)
+        else:
+            return url
+
+    def resolve_url(self, url):
+        (r, sub_soup, _) = self.spider.request_page(url)
+        return self.get_sub_page_url(r, sub_soup)
+
+    async def async_resolve_url(self, url):
+        (r, sub_url) = await self.spider.async_request_page(url, parse='parse_sub_page')
+        return sub_url
+
+    concurrent_resolve = True
+
+    def get_link_url(self, item, page_url):
         url = item.get('href')
         if url.startswith('javascript'):
-            return None
+            return None, False
         elif url.startswith('http'):
-            return url
+            return url, False
         else:
             url = urljoin(page_url, url)
             query = dict(parse_qsl(urlsplit(url).query))
             if 'url' in query:
-                return query['url']
+                return query['url'], False
             else:
-                (r, sub_soup, _) = self.spider.safe_request(url)
-                if r.url.startswith('http://wap.sogou.com/transcoding/sweb') \
-                        or r.url.startswith('http://m.sogou.com/transcoding/sweb') \
-                        or r.url.startswith('http://wap.sogou.com/web/search/'):
-                    btn = sub_soup.find('div', class_='btn')
-                    if btn:
-                        link = btn.find('a')
-                    else:
-                        # 个别情况下 会发生页面里面没有class为btn的div的情况
-                        link = sub_soup.find('a')
-                    if link:
-                        return link.get('href')
-                else:
-                    return r.url
+                return url, True
+
+    def parse_sub_page(self, r, soup, items, page):
+        return self.get_sub_page_url(r, soup)
+
+    def get_sub_page_url(self, r, sub_soup):
+        if r.url.startswith('http://wap.sogou.com/transcoding/sweb') \
+                or r.url.startswith('http://m.sogou.com/transcoding/sweb') \
+                or r.url.startswith('http://wap.sogou.com/web/search/'):
+            btn = sub_soup.find('div', class_='btn')
+            if btn:
+                link = btn.find('a')
+            else:
+                # 个别情况下 会发生页面里面没有class为btn的div的情况
+                link = sub_soup.find('a')
+            if link:
+                return link.get('href')
+        else:
+            return r.url
 
     def get_title(self, item):
         return ''.join(item.findAll(text=lambda text: not isinstance(text, Comment)))
@@ -312,6 +800,44 @@ class SogouMobileRuler(SpiderRuler):
     def has_no_result(self, soup):
         return soup.find('p').find(text=True).strip().split(',')[3] == '0[PAGE_INFO]'
 
+    item_xpath = xpath('//div[%s]' % has_class('vrResult'))
+    link_xpath = xpath('(.//a[%s])[1]' % has_class('resultLink'))
+    any_link_xpath = xpath('(.//a)[1]')
+    page_info_xpath = xpath('(//p)[1]')
+    body_xpath = xpath('//body')
+
+    def lxml_get_all_item(self, tree):
+        items = []
+        for div in self.item_xpath(tree):
+            links = self.link_xpath(div) or self.any_link_xpath(div)
+            if links and links[0].get('href') is not None:
+                items.append(links[0])
+        return items
+
+    def get_page_info(self, tree):
+        return first_string(self.page_info_xpath(tree)[0]).strip().split(',')
+
+    def lxml_has_next_page(self, tree):
+        li = self.get_page_info(tree)
+        return int(li[0]) > int(li[1])
+
+    def lxml_is_forbid(self, r, tree):
+        body = self.body_xpath(tree)[0]
+        if body.text is not None:
+            first = [body.text]
+        elif len(body) == 0:
+            return True
+        elif isinstance(body[0], etree._Comment):
+            first = [body[0].text or '']
+        else:
+            first = body[0].xpath('.//text()')
+        for s in first:
+            if s.strip() == '403':
+                return True
+
+    def lxml_has_no_result(self, tree):
+        return self.get_page_info(tree)[3] == '0[PAGE_INFO]'
+
 
 class BaiduPCRuler(SpiderRuler):
     def __init__(self, spider):
@@ -337,11 +863,17 @@ class BaiduPCRuler(SpiderRuler):
     def engine_name(self):
         return '百度PC'
 
+    # rn是每页的结果数，最多50
+    max_page_size = 50
+
     def get_params(self, keyword, page):
-        return {
+        params = {
             'wd': keyword,
-            'pn': (page - 1) * 10,
+            'pn': (page - 1) * self.page_size,
         }
+        if self.page_size != DEFAULT_PAGE_SIZE:
+            params['rn'] = self.page_size
+        return params
 
     def get_all_item(self, soup):
         div_root = soup.find('div', id='content_left')
@@ -351,17 +883,53 @@ class BaiduPCRuler(SpiderRuler):
             return []
 
     def get_url(self, item, page_url):
+        (url, need_request) = self.get_link_url(item, page_url)
+        if need_request:
+            return self.get_landing_url(item) or self.resolve_url(url)
+        else:
+            return url
+
+    def resolve_url(self, url):
+        return self.spider.get_real_url(url)
+
+    async def async_resolve_url(self, url):
+        return await self.spider.async_get_real_url(url)
+
+    concurrent_resolve = True
+
+    def get_show_url(self, item):
+        link = item.find('a', class_='c-showurl')
+        if link:
+            return link.get_text()
+
+    # 和百度MOBILE的data-log一样，结果块的mu属性就是真实地址；没有的话data-tools里面的url有时候也是真实地址
+    def get_landing_url(self, item):
+        tools = item.find(attrs={'data-tools': True})
+        return self.get_mu_url(item.get('mu'), tools and tools.get('data-tools'))
+
+    @staticmethod
+    def get_mu_url(mu, tools_str):
+        if mu and mu.startswith('http'):
+            return mu
+        if tools_str:
+            try:
+                tools = json.loads(tools_str)
+            except ValueError:
+                return None
+            url = isinstance(tools, dict) and tools.get('url')
+            if url and url.startswith('http') and not url.startswith('http://www.baidu.com/link?'):
+                return url
+
+    def get_link_url(self, item, page_url):
         link = item.find('a')
         if link:
             url = link.get('href')
             if url.startswith('javascript'):
-                return None
-            elif url.startswith('http://www.baidu.com/link?'):
-                return self.spider.get_real_url(url)
+                return None, False
             else:
-                return url
+                return url, url.startswith('http://www.baidu.com/link?')
         else:
-            return None
+            return None, False
 
     def get_title(self, item):
         return ''.join(item.find('a').findAll(text=lambda text: not isinstance(text, Comment)))
@@ -388,6 +956,32 @@ class BaiduPCRuler(SpiderRuler):
         # 这种情况其实是等待加载，不算爬虫，但是和爬虫的解决方式是一样的，所以添加在这里
         return r.url.startswith('https://wappass.baidu.com/static/captcha')
 
+    item_xpath = xpath("(//div[@id='content_left'])[1]/div[not(@id='rs_top_new')]")
+    link_xpath = xpath('(.//a)[1]')
+    title_xpath = link_xpath
+    has_next_page_xpath = xpath("boolean(//a[count(node()) = 1][. = '下一页 >'])")
+    next_page_xpath = xpath("(//*[@id='page'])[1]//a[count(node()) = 1][. = '下一页 >']")
+    forbid_urls = ('https://wappass.baidu.com/static/captcha',)
+    no_result_texts = ('很抱歉，没有找到与', '请检查您的输入是否正确')
+    unsafe_xpath = xpath("boolean(.//div[@class='unsafe_content f13'])")
+    show_url_xpath = xpath('(.//a[%s])[1]' % has_class('c-showurl'))
+    tools_xpath = xpath('(.//*[@data-tools])[1]/@data-tools')
+
+    def lxml_get_landing_url(self, item):
+        tools = self.tools_xpath(item)
+        return self.get_mu_url(item.get('mu'), tools[0] if tools else None)
+
+    def lxml_get_link_url(self, item, page_url):
+        links = self.link_xpath(item)
+        if links:
+            url = links[0].get('href')
+            if url.startswith('javascript'):
+                return None, False
+            else:
+                return url, url.startswith('http://www.baidu.com/link?')
+        else:
+            return None, False
+
 
 class BaiduMobileRuler(SpiderRuler):
     def __init__(self, spider):
@@ -465,6 +1059,20 @@ class BaiduMobileRuler(SpiderRuler):
     def has_no_result(self, soup):
         return page_has_text(soup, '检查输入是否正确') and page_has_text(soup, '抱歉，没有找到与')
 
+    item_xpath = xpath("(//div[@id='results'])[1]//div[@class='c-result result']")
+    title_xpath = xpath('(.//span[%s])[1]' % has_class('c-title-text'))
+    missing_title = ''
+    next_page_only_xpath = xpath('(//a[%s])[1]' % has_class('new-nextpage-only'))
+    next_page_xpath = xpath('(//a[%s])[1]' % has_class('new-nextpage'))
+    forbid_urls = ('https://wappass.baidu.com/static/captcha',)
+    forbid_xpath = xpath("boolean(//*[@id='page-hd']) and not(//*[@id='page'])")
+    no_result_texts = ('检查输入是否正确', '抱歉，没有找到与')
+
+    def lxml_get_next_page_link(self, tree):
+        links = self.next_page_only_xpath(tree) or self.next_page_xpath(tree)
+        if links:
+            return links[0]
+
 
 class SLLPCRuler(SpiderRuler):
     def __init__(self, spider):
@@ -490,6 +1098,8 @@ class SLLPCRuler(SpiderRuler):
     def engine_name(self):
         return '360PC'
 
+    direct_paging = True
+
     def get_params(self, keyword, page):
         return {
             'q': keyword,
@@ -522,6 +1132,12 @@ class SLLPCRuler(SpiderRuler):
     def retry_page(self, soup):
         return soup.find('ul', class_='result') and len(self.get_all_item(soup)) == 0
 
+    item_xpath = xpath('//*[@data-res]')
+    has_next_page_xpath = xpath("boolean(//a[@id='snext'])")
+    forbid_texts = ('亲，系统检测到您操作过于频繁。',)
+    no_result_texts = ('检查输入是否正确', '简化查询词或尝试其他相关词')
+    retry_xpath = xpath('boolean(//ul[%s])' % has_class('result'))
+
 
 class SLLMobileRuler(SpiderRuler):
     def __init__(self, spider):
@@ -547,6 +1163,8 @@ class SLLMobileRuler(SpiderRuler):
     def engine_name(self):
         return '360MOBILE'
 
+    direct_paging = True
+
     def get_params(self, keyword, page):
         return {
             'q': keyword,
@@ -581,6 +1199,125 @@ class SLLMobileRuler(SpiderRuler):
                or (len(soup.prettify().strip()) == 0) \
                or page_has_text(soup, 'MSO.hasNextPage = false;')
 
+    item_xpath = xpath('//*[@data-pcurl]')
+    title_xpath = xpath("(.//h3[%s])[1]" % has_class('res-title'))
+    missing_title = ''
+    forbid_urls = ('http://qcaptcha.so.com/?ret=',)
+    forbid_texts = ('请输入验证码以便正常访问',)
+    no_result_texts = ('很抱歉搜索君没有找到与', '检查输入是否正确')
+
+    def lxml_has_next_page(self, tree):
+        return tree_has_text(tree, 'MSO.hasNextPage = true;')
+
+    def lxml_has_no_result(self, tree):
+        return SpiderRuler.lxml_has_no_result(self, tree) \
+               or len(tree) == 0 \
+               or tree_has_text(tree, 'MSO.hasNextPage = false;')
+
+
+def check_page(ruler, r, soup, keyword, page):
+    if ruler.is_forbid(r, soup):
+        # with open(f'旧型爬虫返回页_{ruler.engine_name}-{keyword}-{page}.html',
+        #           'w', encoding='utf-8') as f:
+        #     f.write(r.url + '\n' + soup.prettify())
+        return PAGE_FORBID, None
+    items = ruler.get_all_item(soup)
+    if len(items) == 0:
+        try:
+            has_no_result = ruler.has_no_result(soup)
+        except KeyboardInterrupt as e:
+            raise e
+        except:
+            has_no_result = False
+        if not has_no_result:
+            if not ruler.retry_page(soup):
+                with open(f'新型爬虫返回页_可以发送给开发进行分析_{ruler.engine_name}-{keyword}-{page}.html',
+                          'w', encoding='utf-8') as f:
+                    f.write(r.url + '\n' + soup.prettify())
+            return PAGE_ABNORMAL, items
+    return PAGE_OK, items
+
+
+def check_tree(ruler, r, tree, keyword, page):
+    if ruler.lxml_is_forbid(r, tree):
+        return PAGE_FORBID, None
+    items = ruler.lxml_get_all_item(tree)
+    if len(items) == 0:
+        try:
+            has_no_result = ruler.lxml_has_no_result(tree)
+        except KeyboardInterrupt as e:
+            raise e
+        except:
+            has_no_result = False
+        if not has_no_result:
+            if not ruler.lxml_retry_page(tree, items):
+                with open(f'新型爬虫返回页_可以发送给开发进行分析_{ruler.engine_name}-{keyword}-{page}.html',
+                          'w', encoding='utf-8') as f:
+                    f.write(r.url + '\n' + r.text)
+            return PAGE_ABNORMAL, items
+    return PAGE_OK, items
+
+
+def parse_response(ruler, r, keyword, page, parse):
+    if PARSE_BACKEND == 'lxml' and parse == 'parse_page' and ruler.support_lxml:
+        with PROFILER.phase(ruler.engine_name, '构建解析树'):
+            tree = get_tree(r.text)
+        with PROFILER.phase(ruler.engine_name, '查找结果条目'):
+            (state, items) = check_tree(ruler, r, tree, keyword, page)
+        if state != PAGE_OK:
+            return state, None
+        with PROFILER.phase(ruler.engine_name, '解析条目'):
+            return state, ruler.lxml_parse_page(r, tree, items, page)
+    with PROFILER.phase(ruler.engine_name, '构建BeautifulSoup'):
+        soup = BeautifulSoup(r.text, 'lxml')
+    with PROFILER.phase(ruler.engine_name, '查找结果条目'):
+        (state, items) = check_page(ruler, r, soup, keyword, page)
+    if state != PAGE_OK:
+        return state, None
+    with PROFILER.phase(ruler.engine_name, '解析条目'):
+        return state, getattr(ruler, parse)(r, soup, items, page)
+
+
+# 解析进程里面用到的ruler，只用来解析页面，不会发出请求，所以不需要spider
+parser_rulers = {}
+
+
+def parse_in_worker(ruler_class, url, text, keyword, page, parse):
+    if ruler_class not in parser_rulers:
+        parser_rulers[ruler_class] = ruler_class(None)
+    return parse_response(parser_rulers[ruler_class], Response(url, None, None, text), keyword, page, parse)
+
+
+# 导入文件第一列是域名，第二列是关键词，第一行是表头
+def read_keyword_domains_map(file_path, is_keyword_domain_map):
+    keyword_domains_map = {}
+    if is_keyword_domain_map:
+        for (domain, keyword) in read_rows(file_path, min_row=2, columns=2):
+            if keyword is not None and domain is not None:
+                if keyword not in keyword_domains_map.keys():
+                    keyword_domains_map[keyword] = set()
+                keyword_domains_map[keyword].add(domain)
+    else:
+        domain_set = set()
+        keyword_set = set()
+        for (domain, keyword) in read_rows(file_path, min_row=2, columns=2):
+            if domain is not None:
+                domain_set.add(domain)
+            if keyword is not None:
+                keyword_set.add(keyword)
+        for keyword in keyword_set:
+            keyword_domains_map[keyword] = domain_set
+    return keyword_domains_map
+
+
+def read_domain_set(file_path):
+    return set(row[0] for row in read_rows(file_path, columns=1))
+
+
+# 报价表格的数据行（不包括表头），核对排名和生成核对结果都要用到，所以全部读出来
+def read_prices(file_path):
+    return list(read_rows(file_path, min_row=2, columns=8))
+
 
 class LittleRankSpider:
     def __init__(self, spider):
@@ -590,56 +1327,81 @@ class LittleRankSpider:
 
     def get_ranks(self, ruler, keyword_domains_map, page):
         result = []
+        keyword_domains_map = compile_keyword_domains_map(keyword_domains_map)
+        if self.spider.max_count > 0:
+            jobs = [(ruler, i + 1, keyword, keyword_domains_map[keyword], page)
+                    for i, keyword in enumerate(keyword_domains_map.keys())]
+            for rank_result in self.spider.run_async(jobs, self.async_get_rank):
+                result += rank_result
+            return result, self.error_list
         searched_keywords = []
         for i, keyword in enumerate(keyword_domains_map.keys()):
-            domain_set = keyword_domains_map[keyword]
-            result += self.get_rank(ruler, i + 1, keyword, domain_set, page)
+            domain_matcher = keyword_domains_map[keyword]
+            result += self.get_rank(ruler, i + 1, keyword, domain_matcher, page)
             searched_keywords.append(keyword)
         return result, self.error_list
 
-    def get_rank(self, ruler, index, keyword, domain_set, page):
+    def get_rank(self, ruler, index, keyword, domain_matcher, page):
         self.spider.reset_session()
         print('开始抓取第%s个关键词：%s' % (index, keyword))
         result = []
         self.page_url = None
         for i in range(page):
-            result += self.get_page(ruler, i + 1, keyword, domain_set)
+            result += self.get_page(ruler, i + 1, keyword, domain_matcher)
+        return result
+
+    async def async_get_rank(self, ruler, index, keyword, domain_matcher, page):
+        print('开始抓取第%s个关键词：%s' % (index, keyword))
+        current_keyword.set(keyword)
+        result = []
+        page_url = None
+        for i in range(page):
+            current_page.set(i + 1)
+            page_result, page_url = await self.async_get_page(ruler, i + 1, keyword, domain_matcher, page_url)
+            result += page_result
         return result
 
-    def get_page(self, ruler, page, keyword, domain_set):
+    def get_page(self, ruler, page, keyword, domain_matcher):
         print('开始第%d页' % page)
+        (_, parsed) = self.spider.get_serp(keyword, page, self.page_url)
+        self.page_url = parsed.next_page_url
+        (urls, errors) = self.spider.resolve_items(parsed.items, domain_matcher)
+        self.add_errors(errors)
+        return self.handle_page(page, keyword, domain_matcher, parsed, urls)
+
+    async def async_get_page(self, ruler, page, keyword, domain_matcher, page_url):
+        print('开始第%d页' % page)
+        (_, parsed) = await self.spider.async_get_serp(keyword, page, page_url)
+        (urls, errors) = await self.spider.async_resolve_items(parsed.items, domain_matcher)
+        self.add_errors(errors)
+        return self.handle_page(page, keyword, domain_matcher, parsed, urls), parsed.next_page_url
+
+    def add_errors(self, errors):
+        for error in errors:
+            self.error_list.append(error)
+            print(error)
+
+    def handle_page(self, page, keyword, domain_matcher, parsed, urls):
         result = []
-        if self.page_url:
-            (r, soup, all_item) = self.spider.safe_request(self.page_url)
-        else:
-            params = ruler.get_params(keyword, page)
-            (r, soup, all_item) = self.spider.safe_request(ruler.base_url, params=params)
-        self.page_url = ruler.get_next_page_url(soup)
         rank = 1
-        for item in all_item:
-            try:
-                url = ruler.get_url(item, r.url)
-            except KeyboardInterrupt as e:
-                raise e
-            except:
-                url = None
-                self.error_list.append(traceback.format_exc())
-                traceback.print_exc()
+        for item, url in zip(parsed.items, urls):
+            if item.error:
+                self.error_list.append(item.error)
+                print(item.error)
             if url is not None:
                 print('本页第%s条URL为%s' % (rank, url))
-                item_list = urlparse(url).netloc.split('.')
-                for domain in domain_set:
-                    if domain == '*' or is_list_include_another_list(domain.split('.'), item_list):
-                        result.append((
-                            domain,
-                            keyword,
-                            page,
-                            rank,
-                            url,
-                            ruler.get_title(item),
-                            datetime.now()
-                        ))
-                        break
+                with PROFILER.phase(self.spider.ruler.engine_name, '匹配域名'):
+                    domain = domain_matcher.match(urlparse(url).netloc)
+                if domain is not None:
+                    result.append((
+                        domain,
+                        keyword,
+                        page,
+                        rank,
+                        url,
+                        item.title,
+                        datetime.now()
+                    ))
                 rank += 1
         return result
 
@@ -648,7 +1410,6 @@ class Spider(metaclass=ABCMeta):
     def __init__(self, ruler_class):
         self.ruler = ruler_class(self)
         self.session = None
-        self.reset_session()
         self.url = ''
         self.text = ''
         self.result = []
@@ -657,8 +1418,33 @@ class Spider(metaclass=ABCMeta):
         cfg = ConfigParser()
         cfg.read('config.ini')
         self.reconnect_interval_time = float(cfg.get('config', 'reconnect_interval_time'))
-        self.error_interval_time = float(cfg.get('config', 'error_interval_time'))
+        self.rate_controller = RateController(self.ruler, cfg)
         self.is_keyword_domain_map = int(cfg.get('config', 'is_keyword_domain_map')) == 1
+        self.max_count = int(cfg.get('config', 'max_count'))
+        self.parse_count = int(cfg.get('config', 'parse_count'))
+        self.resolve_count = max(int(cfg.get('config', 'resolve_count')), 1)
+        self.parallel_pages = max(int(cfg.get('config', 'parallel_pages')), 1)
+        self.metrics = METRICS.engine(self.ruler.engine_name)
+        metrics_port = int(cfg.get('config', 'metrics_port'))
+        if metrics_port > 0:
+            METRICS.start_server(cfg.get('config', 'metrics_host').strip(), metrics_port)
+        self.url_sources = Counter()
+        self.redirect_cache = open_disk_cache('跳转链接.sqlite3',
+                                              float(cfg.get('config', 'redirect_cache_days')) * 24 * 60 * 60,
+                                              int(cfg.get('config', 'redirect_cache_size')))
+        # 解析好的搜索结果页，同一个关键词在不同的导入文件、不同的查询程序里面重复出现的时候不用再请求搜索引擎
+        self.serp_cache = open_disk_cache('搜索结果.sqlite3',
+                                          float(cfg.get('config', 'serp_cache_minutes')) * 60,
+                                          int(cfg.get('config', 'serp_cache_size')))
+        # 异步模式下正在请求的搜索结果页，同时查询同一个关键词的时候等第一个请求的结果
+        self.serp_pending = {}
+        # 整个查询过程共用的连接池，每个域名保持最多resolve_count个连接，换关键词、同时请求子页面的时候都可以复用连接
+        self.adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.resolve_count)
+        self.reset_session()
+        # 请求跳转链接不需要cookie
+        self.resolve_session = self.create_session(False)
+        self.limiter = None
+        self.parse_pool = None
         self.keyword = ''
         self.page = 0
 
@@ -695,7 +1481,7 @@ class Spider(metaclass=ABCMeta):
                 run_mode = input('定时运行（输入1）还是马上运行（输入0）？')
             first_run = False
             if run_mode == '0':
-                self.search()
+                self.run_search()
             elif run_mode == '1':
                 self.start()
             else:
@@ -712,9 +1498,20 @@ class Spider(metaclass=ABCMeta):
         wait_time = (start_time - now).total_seconds()
         print('下次查询时间为%s，将在%s后开始' % (start_time, format_cd_time(wait_time)))
         time.sleep(wait_time)
-        self.search()
+        self.run_search()
         self.start()
 
+    # 开启了profile的时候查询结束输出各阶段的耗时
+    def run_search(self):
+        PROFILER.begin_run()
+        try:
+            self.search()
+        finally:
+            PROFILER.end_run('%s-%s' % (self.get_engine_name(), get_cur_time_filename()))
+
+    def get_engine_name(self):
+        return self.ruler.engine_name
+
     @abstractmethod
     def search(self):
         pass
@@ -726,92 +1523,434 @@ class Spider(metaclass=ABCMeta):
     def safe_request(self, url, *, params=None):
         cur = datetime.now()
         passed = (cur - self.last_request_time).total_seconds()
-        if passed < self.ruler.request_interval_time:
-            time.sleep(self.ruler.request_interval_time - passed)
+        if passed < self.rate_controller.interval:
+            time.sleep(self.rate_controller.interval - passed)
+        (r, soup, items) = self.request_page(url, params=params)
+        self.last_request_time = datetime.now()
+        self.url = r.url
+        self.text = r.text
+        return r, soup, items
+
+    # 请求并检查页面，不等请求间隔，也不记录self.url和self.text，可以在多个线程里面同时请求搜索引擎的子页面
+    def request_page(self, url, *, params=None):
         r = None
         soup = None
         items = None
         times = 0
         while r is None or soup is None:
+            proxy = self.choose_proxy()
+            start = time.monotonic()
             try:
-                r = self.get(url, params=params)
+                with PROFILER.phase(self.ruler.engine_name, '请求页面'):
+                    r = self.get(url, params=params, proxy=proxy)
             # todo 准确判断是否真的是网络断开 来确定是否要等待网络重连
             except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as error:
+                self.metrics.on_retry()
+                PROXY_POOL.report_failure(proxy, self.ruler.engine_name)
                 print('网络断开时请求的URL为：%s' % url)
                 print('认为是网络断开的错误是：%s' % error)
                 print('检查到网络断开，%s秒之后尝试重新抓取' % self.reconnect_interval_time)
                 time.sleep(self.reconnect_interval_time)
                 continue
-            soup = BeautifulSoup(r.text, 'lxml')
+            self.metrics.on_request(time.monotonic() - start)
+            with PROFILER.phase(self.ruler.engine_name, '构建BeautifulSoup'):
+                soup = BeautifulSoup(r.text, 'lxml')
             # with open('1.html', 'w', encoding='utf-8') as f:
             #     f.write(soup.prettify())
-            if self.ruler.is_forbid(r, soup):
-                # with open(f'旧型爬虫返回页_{self.ruler.engine_name}-{self.keyword}-{self.page}.html',
-                #           'w', encoding='utf-8') as f:
-                #     f.write(r.url + '\n' + soup.prettify())
-                print('该IP已被判定为爬虫，暂时无法获取到信息，%s秒之后尝试重新抓取' % self.error_interval_time)
-                time.sleep(self.error_interval_time)
+            with PROFILER.phase(self.ruler.engine_name, '查找结果条目'):
+                (state, items) = check_page(self.ruler, r, soup, self.keyword, self.page)
+            if state == PAGE_FORBID:
+                time.sleep(self.handle_forbid(proxy))
                 r = None
                 soup = None
                 continue
-            items = self.ruler.get_all_item(soup)
-            if len(items) == 0:
-                try:
-                    has_no_result = self.ruler.has_no_result(soup)
-                except KeyboardInterrupt as e:
-                    raise e
-                except:
-                    has_no_result = False
-                if not has_no_result:
-                    if not self.ruler.retry_page(soup):
-                        with open(f'新型爬虫返回页_可以发送给开发进行分析_{self.ruler.engine_name}-{self.keyword}-{self.page}.html',
-                                  'w', encoding='utf-8') as f:
-                            f.write(r.url + '\n' + soup.prettify())
-                    times = times + 1
-                    if times > 5:
-                        raise MyError('尝试多次依然无法获取到正确内容')
-                    print('请求页面内容异常，可能是被认定为是爬虫，暂时无法获取到信息，%s秒之后尝试重新抓取' % self.error_interval_time)
-                    time.sleep(self.error_interval_time)
-                    r = None
-                    continue
-        self.last_request_time = datetime.now()
+            PROXY_POOL.report_success(proxy, self.ruler.engine_name)
+            if state == PAGE_ABNORMAL:
+                times = times + 1
+                if times > 5:
+                    raise MyError('尝试多次依然无法获取到正确内容')
+                time.sleep(self.handle_abnormal('请求页面内容异常，可能是被认定为是爬虫，暂时无法获取到信息'))
+                r = None
+                continue
+            self.rate_controller.on_success()
+            self.metrics.on_page()
+        return r, soup, items
+
+    # 返回(r, 解析结果)，parse是ruler里面用来解析页面的方法名，开启了parse_count的时候在解析进程里面执行
+    async def async_safe_request(self, url, *, params=None, parse='parse_page'):
+        (r, parsed) = await self.async_request_page(url, params=params, parse=parse, wait=self.limiter.wait)
         self.url = r.url
         self.text = r.text
-        return r, soup, items
+        return r, parsed
 
-    def get_real_url(self, start_url):
-        cur = datetime.now()
-        passed = (cur - self.last_request_time).total_seconds()
-        if passed < self.ruler.request_interval_time:
-            time.sleep(self.ruler.request_interval_time - passed)
+    # wait是每次请求之前要等待的方法，搜索引擎的子页面只需要等整个搜索引擎的暂停结束，不用等请求间隔
+    async def async_request_page(self, url, *, params=None, parse='parse_page', wait=None):
+        wait = wait or self.limiter.wait_resume
+        keyword = current_keyword.get()
+        page = current_page.get()
         r = None
-        final_url = None
+        parsed = None
+        times = 0
         while r is None:
+            await wait()
+            proxy = await self.async_choose_proxy()
+            start = time.monotonic()
+            try:
+                with PROFILER.phase(self.ruler.engine_name, '请求页面'):
+                    r = await self.async_get(url, params=params, proxy=proxy)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as error:
+                self.metrics.on_retry()
+                PROXY_POOL.report_failure(proxy, self.ruler.engine_name)
+                print('网络断开时请求的URL为：%s' % url)
+                print('认为是网络断开的错误是：%s' % error)
+                print('检查到网络断开，%s秒之后尝试重新抓取' % self.reconnect_interval_time)
+                await asyncio.sleep(self.reconnect_interval_time)
+                continue
+            self.metrics.on_request(time.monotonic() - start)
+            if self.parse_pool:
+                # 解析进程里面的各阶段统计不到，只统计等待解析的时间
+                with PROFILER.phase(self.ruler.engine_name, '等待解析进程'):
+                    (state, parsed) = await asyncio.get_running_loop().run_in_executor(
+                        self.parse_pool, parse_in_worker, type(self.ruler), r.url, r.text, keyword, page, parse)
+            else:
+                (state, parsed) = parse_response(self.ruler, r, keyword, page, parse)
+            if state == PAGE_FORBID:
+                self.limiter.pause(self.handle_forbid(proxy))
+                r = None
+                continue
+            PROXY_POOL.report_success(proxy, self.ruler.engine_name)
+            if state == PAGE_ABNORMAL:
+                times = times + 1
+                if times > 5:
+                    raise MyError('尝试多次依然无法获取到正确内容')
+                self.limiter.pause(self.handle_abnormal('请求页面内容异常，可能是被认定为是爬虫，暂时无法获取到信息'))
+                r = None
+                continue
+            self.rate_controller.on_success()
+            self.metrics.on_page()
+        return r, parsed
+
+    def get_real_url(self, start_url):
+        times = 0
+        while True:
+            proxy = self.choose_proxy()
             try:
                 headers = {'User-Agent': self.ruler.user_agent}
-                r = requests.head(start_url, headers=headers)
-                final_url = r.headers['Location']
-            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                with PROFILER.phase(self.ruler.engine_name, '请求真实地址'):
+                    r = self.resolve_session.head(to_mock_url(start_url, MOCK_SERVER), headers=headers,
+                                                  timeout=RESOLVE_TIMEOUT, proxies=to_requests_proxies(proxy))
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.Timeout):
+                self.metrics.on_retry()
+                PROXY_POOL.report_failure(proxy, self.ruler.engine_name)
                 print('检查到网络断开，%s秒之后尝试重新抓取' % self.reconnect_interval_time)
                 time.sleep(self.reconnect_interval_time)
                 continue
             if self.ruler.is_forbid(r, BeautifulSoup(r.text, 'lxml')):
-                print('该IP已被判定为爬虫，暂时无法获取到信息，%s秒之后尝试重新抓取' % self.error_interval_time)
-                time.sleep(self.error_interval_time)
+                time.sleep(self.handle_forbid(proxy))
                 continue
-        self.last_request_time = datetime.now()
-        return final_url
+            PROXY_POOL.report_success(proxy, self.ruler.engine_name)
+            if 'Location' not in r.headers:
+                times = times + 1
+                if times > 5:
+                    raise MyError('尝试多次依然无法获取到%s的真实地址' % start_url)
+                time.sleep(self.handle_abnormal('请求真实地址返回异常（状态码%s）' % r.status_code))
+                continue
+            self.metrics.on_resolve()
+            return r.headers['Location']
 
-    def reset_session(self):
-        if self.ruler.enable_session:
-            self.session = requests.Session()
-            self.session.headers.update(self.get_headers())
+    async def async_get_real_url(self, start_url):
+        times = 0
+        while True:
+            await self.limiter.wait_resume()
+            proxy = await self.async_choose_proxy()
+            try:
+                headers = {'User-Agent': self.ruler.user_agent}
+                with PROFILER.phase(self.ruler.engine_name, '请求真实地址'):
+                    async with current_session.get().head(to_mock_url(start_url, MOCK_SERVER), headers=headers,
+                                                          allow_redirects=False, proxy=to_aiohttp_proxy(proxy),
+                                                          timeout=aiohttp.ClientTimeout(total=RESOLVE_TIMEOUT)) as resp:
+                        r = Response(from_mock_url(str(resp.url), MOCK_SERVER), resp.status, resp.headers,
+                                     await resp.text())
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                self.metrics.on_retry()
+                PROXY_POOL.report_failure(proxy, self.ruler.engine_name)
+                print('检查到网络断开，%s秒之后尝试重新抓取' % self.reconnect_interval_time)
+                await asyncio.sleep(self.reconnect_interval_time)
+                continue
+            if self.ruler.is_forbid(r, BeautifulSoup(r.text, 'lxml')):
+                self.limiter.pause(self.handle_forbid(proxy))
+                continue
+            PROXY_POOL.report_success(proxy, self.ruler.engine_name)
+            if 'Location' not in r.headers:
+                times = times + 1
+                if times > 5:
+                    raise MyError('尝试多次依然无法获取到%s的真实地址' % start_url)
+                await asyncio.sleep(self.handle_abnormal('请求真实地址返回异常（状态码%s）' % r.status_code))
+                continue
+            self.metrics.on_resolve()
+            return r.headers['Location']
+
+    # 返回要等待多少秒
+    def handle_abnormal(self, message):
+        self.metrics.on_retry()
+        return self.back_off(message)
+
+    # 被封禁已经单独计数过，这里只降速不再算一次重试
+    def back_off(self, message):
+        wait_time = self.rate_controller.back_off()
+        print('%s，%.1f秒之后尝试重新抓取，%s的请求速度调整为%s'
+              % (message, wait_time, self.ruler.engine_name, self.rate_controller.describe()))
+        return wait_time
+
+    # 开启了代理池的时候选一个代理，所有代理都在暂停的时候等到有代理恢复；没有开启的时候返回None，直接请求
+    def choose_proxy(self):
+        while PROXY_POOL.enabled:
+            proxy = PROXY_POOL.choose(self.ruler.engine_name)
+            if proxy is not None:
+                return proxy
+            wait_time = PROXY_POOL.get_wait_time(self.ruler.engine_name)
+            print('所有代理都被%s判定为爬虫，%.0f秒之后有代理恢复' % (self.ruler.engine_name, wait_time))
+            time.sleep(wait_time)
+        return None
+
+    async def async_choose_proxy(self):
+        while PROXY_POOL.enabled:
+            proxy = PROXY_POOL.choose(self.ruler.engine_name)
+            if proxy is not None:
+                return proxy
+            wait_time = PROXY_POOL.get_wait_time(self.ruler.engine_name)
+            print('所有代理都被%s判定为爬虫，%.0f秒之后有代理恢复' % (self.ruler.engine_name, wait_time))
+            await asyncio.sleep(wait_time)
+        return None
+
+    # 被判定为爬虫的时候返回要等待多少秒：用了代理就只暂停这个代理，马上换一个代理重新请求，不用等待
+    # 请求速度也会降下来
+    def handle_forbid(self, proxy):
+        self.metrics.on_forbid()
+        if proxy is None:
+            return self.back_off('该IP已被判定为爬虫，暂时无法获取到信息')
+        self.rate_controller.back_off()
+        PROXY_POOL.report_forbid(proxy, self.ruler.engine_name)
+        print('%s已被%s判定为爬虫，暂停使用%.0f秒，换一个代理重新抓取'
+              % (PROXY_POOL.describe(proxy), self.ruler.engine_name, PROXY_POOL.cooldown))
+        return 0
+
+    # 搜索结果页缓存里面的(实际请求的URL, 解析结果)，保存的是还没有请求跳转链接的结果，
+    # 跳转链接由调用的地方按照这次要查的域名去解析（大部分都在跳转链接缓存里面）
+    def get_cached_page(self, keyword, page):
+        value = self.serp_cache.get(self.get_serp_key(keyword, page))
+        if value is None:
+            return None
+        (url, items, has_next_page, next_page_url, has_no_result) = json.loads(value)
+        print('第%d页使用缓存的搜索结果' % page)
+        return url, ParsedPage([ParsedItem(*item) for item in items], has_next_page, next_page_url, has_no_result)
+
+    # 每页的结果数不一样的时候第几页对应的结果也不一样
+    def get_serp_key(self, keyword, page):
+        return json.dumps([self.ruler.engine_name, keyword, page, self.ruler.page_size], ensure_ascii=False)
+
+    # 有条目解析出错的页面不缓存，下次重新请求
+    def set_cached_page(self, keyword, page, url, parsed):
+        if any(item.error for item in parsed.items):
+            return
+        self.serp_cache.set(self.get_serp_key(keyword, page),
+                            json.dumps([url, parsed.items, parsed.has_next_page, parsed.next_page_url,
+                                        parsed.has_no_result], ensure_ascii=False))
+
+    # 返回(实际请求的URL, 解析结果)，page_url是上一页解析出来的下一页链接，没有的时候按关键词和页数拼出地址
+    def get_serp(self, keyword, page, page_url):
+        cached = self.get_cached_page(keyword, page)
+        if cached is not None:
+            return cached
+        if page_url:
+            (r, soup, all_item) = self.safe_request(page_url)
+        else:
+            params = self.ruler.get_params(keyword, page)
+            (r, soup, all_item) = self.safe_request(self.ruler.base_url, params=params)
+        with PROFILER.phase(self.ruler.engine_name, '解析条目'):
+            parsed = self.ruler.parse_page(r, soup, all_item, page)
+        self.set_cached_page(keyword, page, r.url, parsed)
+        return r.url, parsed
+
+    async def async_get_serp(self, keyword, page, page_url):
+        cached = self.get_cached_page(keyword, page)
+        if cached is not None:
+            return cached
+        key = (keyword, page)
+        if key in self.serp_pending:
+            print('第%d页正在被其他任务请求，等待它的结果' % page)
+            return await asyncio.shield(self.serp_pending[key])
+        future = asyncio.ensure_future(self.async_fetch_serp(keyword, page, page_url))
+        self.serp_pending[key] = future
+        try:
+            return await future
+        finally:
+            del self.serp_pending[key]
+
+    async def async_fetch_serp(self, keyword, page, page_url):
+        if page_url:
+            (r, parsed) = await self.async_safe_request(page_url)
+        else:
+            params = self.ruler.get_params(keyword, page)
+            (r, parsed) = await self.async_safe_request(self.ruler.base_url, params=params)
+        self.set_cached_page(keyword, page, r.url, parsed)
+        return r.url, parsed
+
+    # 一页里面需要请求才能拿到真实地址的条目：缓存里面有的直接用；显示的域名不符合要查的域名的不用请求，
+    # 用显示的域名代替（排名还是要算上这一条）；剩下的返回在列表里面的位置，由调用的地方去请求
+    def prepare_resolve(self, items, domain_matcher):
+        urls = []
+        pending = []
+        for i, item in enumerate(items):
+            url = item.link_url
+            source = item.url_source
+            if item.need_request:
+                show_domain = get_show_domain(item.show_url)
+                url = self.redirect_cache.get(item.link_url)
+                if url is not None:
+                    source = 'cache'
+                elif show_domain and not item.unsafe and domain_matcher.match(show_domain) is None:
+                    url = 'http://%s/' % show_domain
+                    source = 'skip'
+                else:
+                    source = 'request'
+                    pending.append(i)
+            if item.link_url is not None:
+                self.url_sources[source] += 1
+            urls.append(url)
+        return urls, pending
+
+    def print_url_sources(self):
+        if len(self.url_sources) == 0:
+            return
+        print('%s真实地址来源：%s' % (self.ruler.engine_name, '，'.join(
+            '%s %s条' % (URL_SOURCES[source], self.url_sources[source])
+            for source in URL_SOURCES.keys() if source in self.url_sources)))
+        self.url_sources.clear()
+
+    # 返回(每一条的真实地址, 错误信息列表)，某一条请求出错的时候这一条的地址是None，不影响其他条
+    def resolve_items(self, items, domain_matcher):
+        (urls, pending) = self.prepare_resolve(items, domain_matcher)
+        errors = []
 
-    def get(self, url, *, params=None):
-        if self.ruler.enable_session:
-            return self.session.get(url, params=params)
+        def resolve(index):
+            try:
+                return self.ruler.resolve_url(items[index].link_url)
+            except KeyboardInterrupt as e:
+                raise e
+            except:
+                errors.append(traceback.format_exc())
+                return None
+
+        if self.ruler.concurrent_resolve and len(pending) > 1:
+            with ThreadPoolExecutor(min(self.resolve_count, len(pending))) as executor:
+                resolved = list(executor.map(resolve, pending))
         else:
-            return requests.get(url, params=params, headers=self.get_headers())
+            resolved = [resolve(i) for i in pending]
+        for i, url in zip(pending, resolved):
+            urls[i] = url
+            self.redirect_cache.set(items[i].link_url, url)
+        return urls, errors
+
+    async def async_resolve_items(self, items, domain_matcher):
+        (urls, pending) = self.prepare_resolve(items, domain_matcher)
+        errors = []
+        semaphore = asyncio.Semaphore(self.resolve_count if self.ruler.concurrent_resolve else 1)
+
+        async def resolve(index):
+            async with semaphore:
+                try:
+                    return await self.ruler.async_resolve_url(items[index].link_url)
+                except (KeyboardInterrupt, asyncio.CancelledError) as e:
+                    raise e
+                except:
+                    errors.append(traceback.format_exc())
+                    return None
+
+        resolved = await asyncio.gather(*[resolve(i) for i in pending])
+        for i, url in zip(pending, resolved):
+            urls[i] = url
+            self.redirect_cache.set(items[i].link_url, url)
+        return urls, errors
+
+    def run_async(self, jobs, handler):
+        return asyncio.run(self.async_run(jobs, handler))
+
+    # 开max_count个worker，每个worker每次从jobs里取一个任务，用单独的session（cookie不共享）、共用的连接池去执行
+    # jobs可以是生成器（分布式查询的时候每次取任务都是去任务数据库领取）
+    async def async_run(self, jobs, handler):
+        self.limiter = RateLimiter(self.rate_controller)
+        # 分布式查询的时候jobs是异步生成器（领取任务要等数据库），几个worker轮流取，同一时间只能有一个在等
+        if not hasattr(jobs, '__anext__'):
+            jobs = iter(jobs)
+        jobs_lock = asyncio.Lock()
+        results = []
+        # 没有开启异步模式的时候（AllRankSpider）每个搜索引擎还是一个一个关键词地查询
+        worker_count = max(self.max_count, 1)
+        # AllRankSpider会事先创建好所有搜索引擎共用的解析进程
+        own_pool = self.parse_pool is None and self.parse_count > 0
+        if own_pool:
+            self.parse_pool = ProcessPoolExecutor(self.parse_count)
+        try:
+            # 每个worker同时请求好几页搜索结果或者好几个跳转链接的时候也要有足够的连接
+            async with aiohttp.TCPConnector(limit=worker_count * max(self.parallel_pages, self.resolve_count)) \
+                    as connector:
+                workers = [asyncio.create_task(self.async_worker(jobs, jobs_lock, connector, handler, results))
+                           for _ in range(worker_count)]
+                await asyncio.gather(*workers)
+        finally:
+            if own_pool:
+                self.parse_pool.shutdown(cancel_futures=True)
+                self.parse_pool = None
+        return results
+
+    async def async_worker(self, jobs, jobs_lock, connector, handler, results):
+        while True:
+            job = await self.async_next_job(jobs, jobs_lock)
+            if job is None:
+                return
+            # 和reset_session一样 每个关键词都用新的cookie 关闭了session的搜索引擎就不保存cookie
+            cookie_jar = None if self.ruler.enable_session else aiohttp.DummyCookieJar()
+            async with aiohttp.ClientSession(connector=connector, connector_owner=False,
+                                             headers=self.get_headers(), cookie_jar=cookie_jar) as session:
+                current_session.set(session)
+                results.append(await handler(*job))
+
+    @staticmethod
+    async def async_next_job(jobs, jobs_lock):
+        if not hasattr(jobs, '__anext__'):
+            return next(jobs, None)
+        async with jobs_lock:
+            try:
+                return await jobs.__anext__()
+            except StopAsyncIteration:
+                return None
+
+    async def async_get(self, url, *, params=None, proxy=None):
+        async with current_session.get().get(to_mock_url(url, MOCK_SERVER), params=params,
+                                             proxy=to_aiohttp_proxy(proxy)) as resp:
+            return Response(from_mock_url(str(resp.url), MOCK_SERVER), resp.status, resp.headers,
+                            await resp.text(errors='replace'))
+
+    # 每个关键词都用新的session（新的cookie），连接还是用共用的连接池，不用每个关键词都重新建立连接
+    def reset_session(self):
+        self.session = self.create_session(self.ruler.enable_session)
+        self.session.headers.update(self.get_headers())
+
+    # keep_cookie为False的时候不保存返回的cookie，和原来直接用requests.get一样
+    def create_session(self, keep_cookie):
+        session = requests.Session()
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        if not keep_cookie:
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
+    def get(self, url, *, params=None, proxy=None):
+        r = self.session.get(to_mock_url(url, MOCK_SERVER), params=params, proxies=to_requests_proxies(proxy))
+        r.url = from_mock_url(r.url, MOCK_SERVER)
+        return r
 
     def get_headers(self):
         return {
@@ -833,7 +1972,7 @@ class Spider(metaclass=ABCMeta):
 
 
 class RankSpider(Spider):
-    def __init__(self, ruler_class):
+    def __init__(self, ruler_class, run_main=True):
         Spider.__init__(self, ruler_class)
         self.keyword_domains_map = {}
         self.keyword_count = 0
@@ -841,9 +1980,35 @@ class RankSpider(Spider):
         self.start_time = datetime.now()
         self.searched_keywords = []
         self.filename = ''
-        self.error_list = []
-        self.unsafe_item_list = []
-        self.main()
+        self.result_writer = None
+        self.unsafe_writer = None
+        self.error_log = None
+        self.journal = None
+        # keyword -> {domain: 最早出现的页数}，这次查询已经找到的域名
+        self.found_domains = {}
+        self.rank_history = None
+        cfg = ConfigParser()
+        cfg.read('config.ini')
+        self.stop_when_found = cfg.get('config', 'stop_when_found') == '1'
+        self.adaptive_depth = cfg.get('config', 'adaptive_depth') == '1'
+        # 开启large_page并且搜索引擎支持的时候一次请求相当于普通模式的page_factor页，结果按位置换算回普通模式的页数和排名
+        if cfg.get('config', 'large_page') == '1':
+            page_size = min(self.ruler.max_page_size, PAGE * DEFAULT_PAGE_SIZE)
+            self.ruler.page_size = page_size // DEFAULT_PAGE_SIZE * DEFAULT_PAGE_SIZE
+        self.page_factor = self.ruler.page_size // DEFAULT_PAGE_SIZE
+        # 查完page_count页一共要请求多少次
+        self.request_count = -(-PAGE // self.page_factor)
+        # 分布式查询：协调节点读取导入文件分配任务、合并结果，工作节点只从任务数据库领取关键词
+        work_queue_path = cfg.get('config', 'work_queue').strip()
+        self.work_queue = None
+        if work_queue_path:
+            self.work_queue = open_work_queue(work_queue_path, float(cfg.get('config', 'lease_seconds')))
+        self.is_worker = self.work_queue is not None and cfg.get('config', 'work_queue_role') == 'worker'
+        self.title_time = 0
+        # 分布式查询的时候每个关键词查到的结果先存起来，查完之后写回任务数据库：keyword -> (排名结果, 安全提醒)
+        self.unit_results = {}
+        if run_main:
+            self.main()
 
     def search(self):
         filename_kd_map = self.get_input()
@@ -852,132 +2017,411 @@ class RankSpider(Spider):
 
     def sub_search(self, index, filename, keyword_domains_map):
         print('开始第%s个文件%s' % (index, filename))
-        self.filename = filename
-        self.keyword_domains_map = keyword_domains_map
-        self.started = True
-        self.result = []
-        self.searched_keywords = []
-        self.start_time = datetime.now()
-        self.keyword_count = len(self.keyword_domains_map.keys())
+        self.begin_file(filename, keyword_domains_map)
+        self.open_journal()
         print('总共要查找%s关键词' % self.keyword_count)
-        for i, keyword in enumerate(self.keyword_domains_map.keys()):
-            self.keyword_index = i + 1
-            self.keyword = keyword
-            domain_set = self.keyword_domains_map[keyword]
-            self.get_rank(i + 1, keyword, domain_set)
+        if self.max_count > 0:
+            asyncio.run(self.async_crawl())
+        else:
+            self.crawl()
+        self.merge_units()
         self.save_result()
+        self.journal.remove()
         end_time = datetime.now()
         print('本次查询用时%s' % format_cd_time((end_time - self.start_time).total_seconds()))
         self.started = False
 
+    # 同时查询所有搜索引擎的时候 结果都写到同一个result_writer里面
+    def begin_file(self, filename, keyword_domains_map, result_writer=None):
+        self.filename = filename
+        # 关键词 -> 编译好的DomainMatcher
+        self.keyword_domains_map = compile_keyword_domains_map(keyword_domains_map)
+        self.started = True
+        self.searched_keywords = []
+        self.start_time = datetime.now()
+        self.keyword_count = len(self.keyword_domains_map.keys())
+        self.metrics.begin_keywords(self.keyword_count)
+        time_str = get_cur_time_filename()
+        if result_writer is None:
+            result_writer = ResultWriter('关键词排名-%s-%s-%s' % (self.get_engine_name(), filename, time_str),
+                                         RANK_HEADER, RESULT_FORMAT)
+            # 工作节点不生成结果文件
+            if not self.is_worker:
+                result_writer.open()
+        self.result_writer = result_writer
+        if self.work_queue is not None and not self.is_worker:
+            self.work_queue.add_units(filename, self.ruler.engine_name, keyword_domains_map)
+        self.unsafe_writer = ResultWriter('关键词是否空白以及安全提醒网站-%s-%s' % (self.ruler.engine_name, time_str),
+                                          UNSAFE_HEADER, RESULT_FORMAT)
+        self.error_log = ErrorLog('排名查询过程中产生的错误-%s-%s.log' % (self.ruler.engine_name, time_str))
+        self.found_domains = {}
+        # 不管有没有开启adaptive_depth都记录下来，开启之后马上就可以用上
+        self.rank_history = RankHistory(self.ruler.engine_name)
+
+    def open_journal(self):
+        self.journal = CrawlJournal(self.ruler.engine_name, self.filename)
+        if self.journal.has_record():
+            print('%s发现上次没有查询完的断点记录，已经查询过的关键词和页数会直接使用记录里面的结果'
+                  % self.ruler.engine_name)
+
+    # 把断点记录里面这个关键词已经查询过的页的结果恢复回来，返回接下来要查询的页数和地址，已经全部查询完了就返回None
+    def restore_keyword(self, keyword):
+        pages = self.journal.get_pages(keyword)
+        for record in pages:
+            self.write_result(record['result'], record['unsafe'])
+            self.add_found(keyword, record['result'])
+        if self.journal.is_done(keyword):
+            return None, None
+        if len(pages) != 0:
+            last = pages[-1]
+            if not last['has_next_page'] or last['page'] >= PAGE:
+                return None, None
+            return last['page'] + 1, last['next_page_url']
+        return 1, None
+
+    def get_jobs(self):
+        if self.work_queue is not None:
+            return self.lease_jobs()
+        return [(i + 1, keyword, self.keyword_domains_map[keyword])
+                for i, keyword in enumerate(self.keyword_domains_map.keys())]
+
+    # 每次从任务数据库领取一个这个搜索引擎的关键词，没有可以领取的就结束
+    def lease_jobs(self):
+        index = len(self.searched_keywords)
+        while True:
+            keyword = self.work_queue.lease(self.filename, self.ruler.engine_name)
+            if keyword is None:
+                return
+            index += 1
+            yield index, keyword, self.keyword_domains_map[keyword]
+
+    # 和lease_jobs一样，领取任务要等sqlite的锁（最多等60秒），放到线程里面，不会卡住其他关键词和其他搜索引擎
+    async def async_lease_jobs(self):
+        loop = asyncio.get_running_loop()
+        index = len(self.searched_keywords)
+        while True:
+            keyword = await loop.run_in_executor(None, self.work_queue.lease, self.filename, self.ruler.engine_name)
+            if keyword is None:
+                return
+            index += 1
+            yield index, keyword, self.keyword_domains_map[keyword]
+
+    def crawl(self):
+        while True:
+            for (index, keyword, domain_matcher) in self.get_jobs():
+                self.keyword_index = index
+                self.keyword = keyword
+                self.get_rank(index, keyword, domain_matcher)
+            if not self.wait_units():
+                break
+            time.sleep(UNIT_POLL_INTERVAL)
+
+    async def async_crawl(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = self.async_lease_jobs() if self.work_queue is not None else self.get_jobs()
+            await self.async_run(jobs, self.async_get_rank)
+            if not await loop.run_in_executor(None, self.wait_units):
+                break
+            await asyncio.sleep(UNIT_POLL_INTERVAL)
+
+    # 协调节点查完自己能领取的关键词之后，还要等其他节点查完；其他节点的租约过期之后协调节点会重新领取自己查
+    def wait_units(self):
+        if self.work_queue is None or self.is_worker:
+            return False
+        count = self.work_queue.count_unfinished(self.filename, self.ruler.engine_name)
+        if count == 0:
+            return False
+        print('%s还有%s个关键词在其他节点查询，%s秒之后再检查'
+              % (self.ruler.engine_name, count, UNIT_POLL_INTERVAL))
+        return True
+
+    # 协调节点把所有节点查到的结果写到结果文件
+    def merge_units(self):
+        if self.work_queue is None or self.is_worker:
+            return
+        for (keyword, result, unsafe_items) in self.work_queue.get_results(self.filename, self.ruler.engine_name):
+            self.write_rows(result, unsafe_items)
+            if keyword not in self.searched_keywords:
+                self.searched_keywords.append(keyword)
+        self.work_queue.remove_batch(self.filename, self.ruler.engine_name)
+
     def get_input(self):
+        if self.is_worker:
+            return self.get_queue_input()
         filename_kd_map = {}
         path = '.\\import'
-        for file in os.listdir(path):
+        for file in list_input_files(path):
             file_path = os.path.join(path, file)
-            wb = load_workbook(file_path)
-            ws = wb.active
-            keyword_domains_map = {}
-            if self.is_keyword_domain_map:
-                for row in ws.iter_rows(min_row=2, values_only=True):
-                    keyword = row[1]
-                    domain = row[0]
-                    if keyword is not None and domain is not None:
-                        if keyword not in keyword_domains_map.keys():
-                            keyword_domains_map[keyword] = set()
-                        keyword_domains_map[keyword].add(domain)
-            else:
-                domain_set = set()
-                keyword_set = set()
-                for row in ws.iter_rows(min_row=2, values_only=True):
-                    keyword = row[1]
-                    domain = row[0]
-                    if domain is not None:
-                        domain_set.add(domain)
-                    if keyword is not None:
-                        keyword_set.add(keyword)
-                for keyword in keyword_set:
-                    keyword_domains_map[keyword] = domain_set
-            filename_kd_map[file] = keyword_domains_map
+            filename_kd_map[file] = input_cache.load(file_path, read_keyword_domains_map, self.is_keyword_domain_map)
         return filename_kd_map
 
-    def get_rank(self, index, keyword, domain_set):
+    # 工作节点的导入文件就是任务数据库里面还没有查完的批次，还没有的时候一直等协调节点添加
+    def get_queue_input(self):
+        batches = self.work_queue.get_batches()
+        while len(batches) == 0:
+            print('任务数据库里面还没有要查询的关键词，%s秒之后再检查' % UNIT_POLL_INTERVAL)
+            time.sleep(UNIT_POLL_INTERVAL)
+            batches = self.work_queue.get_batches()
+        return {batch: self.work_queue.get_keyword_domains_map(batch) for batch in batches}
+
+    def get_rank(self, index, keyword, domain_matcher):
         print('开始抓取第%s个关键词：%s' % (index, keyword))
         self.reset_session()
-        page_url = None
-        for i in range(PAGE):
+        (start_page, page_url) = self.restore_keyword(keyword)
+        if start_page is None:
+            print('关键词%s在断点记录里面已经查询完毕' % keyword)
+            self.finish_keyword(keyword, True)
+            return
+        complete = True
+        for i in range((start_page - 1) // self.page_factor, self.request_count):
             self.page = i + 1
             try:
-                page_url, soup = self.get_page(i + 1, keyword, domain_set, page_url)
-                if not soup or not self.ruler.has_next_page(soup):
+                page_url, parsed = self.get_page(i + 1, keyword, domain_matcher, page_url)
+                if not parsed or not parsed.has_next_page or self.can_stop(keyword, domain_matcher,
+                                                                           self.get_last_page(i + 1)):
                     break
             except KeyboardInterrupt as e:
                 raise e
             except:
-                self.error_list.append('关键词：%s，页数：%s，错误：\n%s' % (keyword, i + 1, traceback.format_exc()))
+                complete = False
+                self.error_log.append('关键词：%s，页数：%s，错误：\n%s' % (keyword, i + 1, traceback.format_exc()))
                 traceback.print_exc()
-        self.searched_keywords.append(keyword)
+        self.journal.record_done(keyword)
+        self.finish_keyword(keyword, complete)
 
-    def get_page(self, page, keyword, domain_set, page_url):
-        print('开始第%d页' % page)
-        if page_url:
-            (r, soup, all_item) = self.safe_request(page_url)
-        else:
-            params = self.ruler.get_params(keyword, page)
-            (r, soup, all_item) = self.safe_request(self.ruler.base_url, params=params)
-        if page == 1:
+    async def async_get_rank(self, index, keyword, domain_matcher):
+        print('开始抓取第%s个关键词：%s' % (index, keyword))
+        self.keyword_index = index
+        current_keyword.set(keyword)
+        (start_page, page_url) = self.restore_keyword(keyword)
+        if start_page is None:
+            print('关键词%s在断点记录里面已经查询完毕' % keyword)
+            await self.async_finish_keyword(keyword, True)
+            return
+        if self.parallel_pages > 1 and self.ruler.direct_paging:
+            complete = await self.async_get_pages_parallel(keyword, domain_matcher, start_page)
+            self.journal.record_done(keyword)
+            await self.async_finish_keyword(keyword, complete)
+            return
+        complete = True
+        for i in range((start_page - 1) // self.page_factor, self.request_count):
+            current_page.set(i + 1)
             try:
-                has_no_result = self.ruler.has_no_result(soup)
-            except KeyboardInterrupt as e:
+                page_url, parsed = await self.async_get_page(i + 1, keyword, domain_matcher, page_url)
+                if not parsed or not parsed.has_next_page or self.can_stop(keyword, domain_matcher,
+                                                                           self.get_last_page(i + 1)):
+                    break
+            except (KeyboardInterrupt, asyncio.CancelledError) as e:
                 raise e
             except:
-                has_no_result = False
-            self.unsafe_item_list.append((keyword, (has_no_result and "是") or "否", None, None, None))
-        # with open('%s-%s.html' % (keyword, page), 'w', encoding='utf-8') as f:
-        #     f.write(soup.prettify())
-        print('本页实际请求URL为%s' % r.url)
-        os.system('title %s%s 关键词：%s/%s 页数：%s/%s 已用时：%s'
+                complete = False
+                self.error_log.append('关键词：%s，页数：%s，错误：\n%s' % (keyword, i + 1, traceback.format_exc()))
+                traceback.print_exc()
+        self.journal.record_done(keyword)
+        await self.async_finish_keyword(keyword, complete)
+
+    # 每次同时请求parallel_pages页（请求之间还是按照请求间隔排队），请求完了按顺序处理，
+    # 遇到没有下一页或者可以提前结束的页，后面已经请求到的页都不要；返回有没有页面出错
+    async def async_get_pages_parallel(self, keyword, domain_matcher, start_page):
+        complete = True
+        first = (start_page - 1) // self.page_factor + 1
+        while first <= self.request_count:
+            pages = range(first, min(first + self.parallel_pages, self.request_count + 1))
+            fetched_pages = await asyncio.gather(*[self.async_fetch_page(keyword, page) for page in pages],
+                                                 return_exceptions=True)
+            for page, fetched in zip(pages, fetched_pages):
+                current_page.set(page)
+                try:
+                    if isinstance(fetched, BaseException):
+                        raise fetched
+                    (_, parsed) = await self.async_handle_serp(page, keyword, domain_matcher, fetched)
+                    if not parsed.has_next_page or self.can_stop(keyword, domain_matcher, self.get_last_page(page)):
+                        return complete
+                except (KeyboardInterrupt, asyncio.CancelledError) as e:
+                    raise e
+                except:
+                    complete = False
+                    self.error_log.append('关键词：%s，页数：%s，错误：\n%s' % (keyword, page, traceback.format_exc()))
+                    traceback.print_exc()
+            first += self.parallel_pages
+        return complete
+
+    async def async_fetch_page(self, keyword, page):
+        current_page.set(page)
+        print('开始第%d页' % page)
+        return await self.async_get_serp(keyword, page, None)
+
+    def add_found(self, keyword, result):
+        found = self.found_domains.setdefault(keyword, {})
+        for (domain, _, page, _, _, _, _) in result:
+            found.setdefault(domain, page)
+
+    # 提前结束翻页：开启了stop_when_found并且要查的域名都已经找到了；
+    # 或者开启了adaptive_depth，上次排名的域名这次都已经找到了，并且已经查到了上次最深的那一页
+    # 上次排名的域名这次还没有找到（排名掉了）的时候继续往后查完整的页数
+    def can_stop(self, keyword, domain_matcher, page):
+        found = self.found_domains.get(keyword, {})
+        if self.stop_when_found and domain_matcher.is_all_found(found):
+            print('关键词%s要查的域名都已经找到，不再往后翻页' % keyword)
+            return True
+        if self.adaptive_depth:
+            # 已经不在要查的域名里面的不算
+            last = {domain: last_page for domain, last_page in (self.rank_history.get(keyword) or {}).items()
+                    if domain_matcher.tracks(domain)}
+            if last and page >= max(last.values()) and all(domain in found for domain in last.keys()):
+                print('关键词%s上次排名的域名都已经找到，不再往后翻页' % keyword)
+                return True
+        return False
+
+    # 在Windows控制台的标题上显示进度，启动进程的开销比较大，每TITLE_INTERVAL秒最多更新一次；
+    # 其他地方看进度用metrics_port
+    def show_progress(self, page):
+        now = time.monotonic()
+        if os.name != 'nt' or now - self.title_time < TITLE_INTERVAL:
+            return
+        self.title_time = now
+        os.system('title %s%s 关键词：%s/%s 页数：%s/%s 已用时：%s 速度：%s'
                   % (self.ruler.engine_name, '排名', self.keyword_index, self.keyword_count, page, PAGE,
-                     format_cd_time((datetime.now() - self.start_time).total_seconds())))
-        rank = 1
-        for item in all_item:
-            url = self.ruler.get_url(item, r.url)
+                     format_cd_time((datetime.now() - self.start_time).total_seconds()),
+                     self.rate_controller.describe()))
+
+    # 第page次请求包含的最后一页（普通模式下的页数）
+    def get_last_page(self, page):
+        return min(page * self.page_factor, PAGE)
+
+    # 第page次请求里面第index条有地址的结果在普通模式下的(页数, 排名)
+    def get_position(self, page, index):
+        if self.page_factor == 1:
+            return page, index + 1
+        return (page - 1) * self.page_factor + index // DEFAULT_PAGE_SIZE + 1, index % DEFAULT_PAGE_SIZE + 1
+
+    # 有页面出错的关键词找到的域名可能不完整，不更新排名记录，免得下次少查几页
+    def finish_keyword(self, keyword, complete):
+        self.record_keyword(keyword, complete)
+        if self.work_queue is not None:
+            (result, unsafe_items) = self.unit_results.pop(keyword, ([], []))
+            self.work_queue.complete(self.filename, self.ruler.engine_name, keyword, result, unsafe_items)
+
+    # 和finish_keyword一样，写回任务数据库放到线程里面
+    async def async_finish_keyword(self, keyword, complete):
+        self.record_keyword(keyword, complete)
+        if self.work_queue is not None:
+            (result, unsafe_items) = self.unit_results.pop(keyword, ([], []))
+            await asyncio.get_running_loop().run_in_executor(None, self.work_queue.complete, self.filename,
+                                                             self.ruler.engine_name, keyword, result, unsafe_items)
+
+    def record_keyword(self, keyword, complete):
+        found = self.found_domains.pop(keyword, {})
+        if complete:
+            self.rank_history.update(keyword, found)
+        self.searched_keywords.append(keyword)
+        self.metrics.on_keyword_done()
+
+    def get_page(self, page, keyword, domain_matcher, page_url):
+        print('开始第%d页' % page)
+        (request_url, parsed) = self.get_serp(keyword, page, page_url)
+        (urls, errors) = self.resolve_items(parsed.items, domain_matcher)
+        self.add_errors(keyword, page, errors)
+        return self.handle_page(page, keyword, domain_matcher, request_url, parsed, urls)
+
+    async def async_get_page(self, page, keyword, domain_matcher, page_url):
+        print('开始第%d页' % page)
+        fetched = await self.async_get_serp(keyword, page, page_url)
+        return await self.async_handle_serp(page, keyword, domain_matcher, fetched)
+
+    # fetched是async_get_serp返回的(实际请求的URL, 解析结果)
+    async def async_handle_serp(self, page, keyword, domain_matcher, fetched):
+        (request_url, parsed) = fetched
+        (urls, errors) = await self.async_resolve_items(parsed.items, domain_matcher)
+        self.add_errors(keyword, page, errors)
+        return self.handle_page(page, keyword, domain_matcher, request_url, parsed, urls)
+
+    def add_errors(self, keyword, page, errors):
+        for error in errors:
+            self.error_log.append('关键词：%s，页数：%s，错误：\n%s' % (keyword, page, error))
+            print(error)
+
+    def handle_page(self, page, keyword, domain_matcher, request_url, parsed, urls):
+        page_result = []
+        page_unsafe_items = []
+        if page == 1:
+            page_unsafe_items.append((keyword, (parsed.has_no_result and "是") or "否", None, None, None))
+        print('本页实际请求URL为%s' % request_url)
+        last_page = self.get_last_page(page)
+        self.show_progress(last_page)
+        index = 0
+        for item, url in zip(parsed.items, urls):
+            if item.error:
+                self.error_log.append('关键词：%s，页数：%s，错误：\n%s' % (keyword, page, item.error))
+                print(item.error)
             if url is not None:
-                print('本页第%s条URL为%s' % (rank, url))
-                item_list = urlparse(url).netloc.split('.')
-                for domain in domain_set:
-                    if domain == '*' or is_list_include_another_list(domain.split('.'), item_list):
-                        self.result.append((
-                            domain,
-                            keyword,
-                            page,
-                            rank,
-                            url,
-                            self.ruler.get_title(item),
-                            datetime.now()
-                        ))
-                        break
-                if self.ruler.is_unsafe(item):
-                    self.unsafe_item_list.append((keyword, None, url, page, rank))
-                rank += 1
-        return self.ruler.get_next_page_url(soup), soup
+                (item_page, rank) = self.get_position(page, index)
+                index += 1
+                # 一次请求的结果超出了page_count页的部分不要
+                if item_page > PAGE:
+                    break
+                print('本页第%s条URL为%s' % (index, url))
+                with PROFILER.phase(self.ruler.engine_name, '匹配域名'):
+                    domain = domain_matcher.match(urlparse(url).netloc)
+                if domain is not None:
+                    page_result.append((
+                        domain,
+                        keyword,
+                        item_page,
+                        rank,
+                        url,
+                        item.title,
+                        datetime.now()
+                    ))
+                if item.unsafe:
+                    page_unsafe_items.append((keyword, None, url, item_page, rank))
+        self.write_result(page_result, page_unsafe_items)
+        self.add_found(keyword, page_result)
+        # 断点记录里面记普通模式下的页数，恢复的时候从下一页对应的那次请求开始
+        self.journal.record_page(keyword, last_page, page_result, page_unsafe_items,
+                                 parsed.next_page_url, parsed.has_next_page)
+        return parsed.next_page_url, parsed
+
+    # 分布式查询的时候结果先存起来，查完这个关键词之后写回任务数据库，最后由协调节点写到结果文件
+    def write_result(self, result, unsafe_items):
+        if self.work_queue is None:
+            self.write_rows(result, unsafe_items)
+            return
+        for row in result:
+            self.unit_results.setdefault(row[1], ([], []))[0].append(row)
+        for unsafe_item in unsafe_items:
+            self.unit_results.setdefault(unsafe_item[0], ([], []))[1].append(unsafe_item)
+
+    def write_rows(self, result, unsafe_items):
+        for (domain, keyword, page, rank, url, title, date_time) in result:
+            time_str = date_time.strftime('%Y/%m/%d')
+            self.result_writer.append((domain, keyword, self.ruler.engine_name, page, rank, url, title, time_str))
+        for unsafe_item in unsafe_items:
+            self.unsafe_writer.append(unsafe_item)
 
     def save_result(self):
         if not self.started:
             return
-        file_name = '关键词排名-%s-%s-%s.xlsx' % (self.ruler.engine_name, self.filename, get_cur_time_filename())
-        wb = Workbook()
-        ws = wb.active
-        ws.append(('域名', '关键词', '搜索引擎', '页数', '排名', '真实地址', '标题', '查询时间'))
-        for (domain, keyword, page, rank, url, title, date_time) in self.result:
-            time_str = date_time.strftime('%Y/%m/%d')
-            ws.append((domain, keyword, self.ruler.engine_name, page, rank, url, title, time_str))
-        wb.save(file_name)
-        self.result = []
-        print('查询结束，查询结果保存在 %s' % file_name)
-        self.save_un_searched()
-        self.save_error_list(self.error_list)
-        self.save_unsafe_item_list()
+        with PROFILER.phase(self.ruler.engine_name, '保存结果'):
+            file_name = self.result_writer.close()
+        if self.is_worker:
+            print('查询结束，查询结果已经写回任务数据库，由协调节点合并到结果文件')
+        else:
+            print('查询结束，查询结果保存在 %s' % file_name)
+        self.save_others()
+
+    def save_others(self):
+        if self.work_queue is not None:
+            self.work_queue.release_held()
+        self.rank_history.save()
+        self.print_url_sources()
+        with PROFILER.phase(self.ruler.engine_name, '保存结果'):
+            # 工作节点只查了自己领取的关键词
+            if not self.is_worker:
+                self.save_un_searched()
+            self.save_error_log()
+            self.unsafe_writer.close()
 
     def save_un_searched(self):
         un_searched_keywords = []
@@ -985,7 +2429,7 @@ class RankSpider(Spider):
             if keyword not in self.searched_keywords:
                 un_searched_keywords.append(keyword)
         if len(un_searched_keywords) != 0:
-            file_name = '未查找关键词-%s.xlsx' % get_cur_time_filename()
+            file_name = '未查找关键词-%s-%s.xlsx' % (self.ruler.engine_name, get_cur_time_filename())
             wb = Workbook()
             ws = wb.active
             for keyword in un_searched_keywords:
@@ -993,40 +2437,112 @@ class RankSpider(Spider):
             wb.save(file_name)
             print('未查询结果保存在 %s' % file_name)
 
-    def save_error_list(self, err_list):
-        if len(err_list) == 0:
+    def save_error_log(self):
+        filename = self.error_log.close()
+        if filename is None:
             return
-        filename = f'排名查询过程中产生的错误-{self.ruler.engine_name}-{get_cur_time_filename()}.log'
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write('\n\n'.join(err_list))
         print(filename)
         print('排名查询过程中产生了一些错误，虽然没有终止运行，但是可能会让结果不够准确，请将记录发给开发人员')
 
-    def save_unsafe_item_list(self):
-        if len(self.unsafe_item_list) == 0:
+
+class AllRankSpider(RankSpider):
+    """在一个进程里面同时查询所有搜索引擎的排名，导入的文件只读取一次，每个搜索引擎有自己的队列和请求间隔"""
+
+    def __init__(self, ruler_classes):
+        self.spiders = [RankSpider(ruler_class, run_main=False) for ruler_class in ruler_classes]
+        # 只保留所有搜索引擎共用的部分，请求、断点记录、安全提醒、错误记录、排名历史都由每个搜索引擎自己的RankSpider负责
+        spider = self.spiders[0]
+        self.url = ''
+        self.text = ''
+        self.started = False
+        self.start_time = datetime.now()
+        self.keyword_count = 0
+        self.result_writer = None
+        self.is_keyword_domain_map = spider.is_keyword_domain_map
+        self.parse_count = spider.parse_count
+        self.parse_pool = None
+        self.work_queue = spider.work_queue
+        self.is_worker = spider.is_worker
+        self.main()
+
+    # 只打开共用的结果文件，每个搜索引擎的begin_file再往里面写
+    def begin_file(self, filename, keyword_domains_map, result_writer=None):
+        self.started = True
+        self.start_time = datetime.now()
+        self.keyword_count = len(keyword_domains_map)
+        self.result_writer = ResultWriter('关键词排名-%s-%s-%s' % (self.get_engine_name(), filename,
+                                                                 get_cur_time_filename()),
+                                          RANK_HEADER, RESULT_FORMAT)
+        # 工作节点不生成结果文件
+        if not self.is_worker:
+            self.result_writer.open()
+
+    def sub_search(self, index, filename, keyword_domains_map):
+        print('开始第%s个文件%s' % (index, filename))
+        self.begin_file(filename, keyword_domains_map)
+        for spider in self.spiders:
+            spider.begin_file(filename, keyword_domains_map, self.result_writer)
+            spider.open_journal()
+        print('%s个搜索引擎，每个总共要查找%s关键词' % (len(self.spiders), self.keyword_count))
+        asyncio.run(self.async_search())
+        for spider in self.spiders:
+            spider.merge_units()
+        self.save_result()
+        for spider in self.spiders:
+            spider.journal.remove()
+        end_time = datetime.now()
+        print('本次查询用时%s' % format_cd_time((end_time - self.start_time).total_seconds()))
+        self.started = False
+
+    # 一个搜索引擎被判定为爬虫在等待的时候 其他搜索引擎不受影响
+    async def async_search(self):
+        if self.parse_count > 0:
+            self.parse_pool = ProcessPoolExecutor(self.parse_count)
+        for spider in self.spiders:
+            spider.parse_pool = self.parse_pool
+        try:
+            await asyncio.gather(*[spider.async_crawl() for spider in self.spiders])
+        finally:
+            if self.parse_pool:
+                self.parse_pool.shutdown(cancel_futures=True)
+                self.parse_pool = None
+            for spider in self.spiders:
+                spider.parse_pool = None
+
+    def get_engine_name(self):
+        return '全部'
+
+    def save_result(self):
+        if not self.started:
             return
-        filename = f'关键词是否空白以及安全提醒网站-{self.ruler.engine_name}-{get_cur_time_filename()}.xlsx'
-        wb = Workbook()
-        ws = wb.active
-        ws.append(('关键词', '是否空白', '安全提醒', '页数', '排名'))
-        for (keyword, has_no_result, unsafe_url, page, rank) in self.unsafe_item_list:
-            ws.append((keyword, has_no_result, unsafe_url, page, rank))
-        wb.save(filename)
+        with PROFILER.phase(self.get_engine_name(), '保存结果'):
+            file_name = self.result_writer.close()
+        if self.is_worker:
+            print('查询结束，查询结果已经写回任务数据库，由协调节点合并到结果文件')
+        else:
+            print('查询结束，查询结果保存在 %s' % file_name)
+        for spider in self.spiders:
+            spider.save_others()
 
 
 class SiteSpider(Spider):
     def __init__(self, ruler_class):
         Spider.__init__(self, ruler_class)
-        self.domain_titles_map = {}
+        self.result_writer = None
         self.main()
 
     def search(self):
         self.started = True
         start_time = datetime.now()
-        self.domain_titles_map = {}
+        self.result_writer = ResultWriter('收录标题-%s-%s' % (self.ruler.engine_name, get_cur_time_filename()),
+                                          ('域名', '标题'), RESULT_FORMAT)
+        self.result_writer.open()
         domain_set = self.get_input()
-        for domain in domain_set:
-            self.get_domain(domain)
+        if self.max_count > 0:
+            self.run_async([(domain,) for domain in domain_set], self.async_get_domain)
+        else:
+            for domain in domain_set:
+                self.get_domain(domain)
         self.save_result()
         end_time = datetime.now()
         print('本次查询用时%s' % format_cd_time((end_time - start_time).total_seconds()))
@@ -1035,47 +2551,88 @@ class SiteSpider(Spider):
     def get_input(self):
         path = '.\\要查收录的网址列表XLSX'
         domain_set = set()
-        for file in os.listdir(path):
-            file_path = os.path.join(path, file)
-            wb = load_workbook(file_path)
-            ws = wb.active
-            for row in ws.iter_rows(values_only=True):
-                domain_set.add(row[0])
+        for file in list_input_files(path):
+            domain_set |= input_cache.load(os.path.join(path, file), read_domain_set)
         return domain_set
 
     def get_domain(self, domain):
         print('开始查找的域名为 %s' % domain)
-        self.domain_titles_map[domain] = []
+        self.result_writer.add_sheet(domain)
+        page = 1
+        parsed = self.get_page(domain, page, None)
+        while parsed and parsed.has_next_page:
+            page += 1
+            parsed = self.get_page(domain, page, parsed.next_page_url)
+
+    async def async_get_domain(self, domain):
+        print('开始查找的域名为 %s' % domain)
+        current_keyword.set('site:%s' % domain)
+        self.result_writer.add_sheet(domain)
+        if self.parallel_pages > 1 and self.ruler.direct_paging:
+            await self.async_get_pages_parallel(domain)
+            return
         page = 1
-        soup = self.get_page(domain, page, None)
-        page_url = self.ruler.get_next_page_url(soup)
-        while soup and self.ruler.has_next_page(soup):
+        current_page.set(page)
+        parsed = await self.async_get_page(domain, page, None)
+        while parsed and parsed.has_next_page:
             page += 1
-            soup = self.get_page(domain, page, page_url)
-            page_url = self.ruler.get_next_page_url(soup)
+            current_page.set(page)
+            parsed = await self.async_get_page(domain, page, parsed.next_page_url)
+
+    # 和RankSpider.async_get_pages_parallel一样，每次同时请求parallel_pages页，没有下一页之后的页都不要
+    # 出错的页跳过，继续处理后面的页；一批全部出错（不知道还有没有下一页）或者到了SITE_MAX_PAGE页就结束
+    async def async_get_pages_parallel(self, domain):
+        first = 1
+        while first <= SITE_MAX_PAGE:
+            pages = range(first, min(first + self.parallel_pages, SITE_MAX_PAGE + 1))
+            fetched_pages = await asyncio.gather(*[self.async_fetch_page(domain, page) for page in pages],
+                                                 return_exceptions=True)
+            all_failed = True
+            for page, fetched in zip(pages, fetched_pages):
+                try:
+                    if isinstance(fetched, BaseException):
+                        raise fetched
+                    all_failed = False
+                    self.append_titles(domain, fetched)
+                    if not fetched.has_next_page:
+                        return
+                except (KeyboardInterrupt, asyncio.CancelledError) as e:
+                    raise e
+                except:
+                    print('域名：%s，页数：%s，错误：' % (domain, page))
+                    traceback.print_exc()
+            if all_failed:
+                return
+            first += self.parallel_pages
 
+    # 和RankSpider一样通过get_serp请求，查询的关键词就是site:域名，搜索结果缓存也用同一个
     def get_page(self, domain, page, page_url):
         print('开始第%d页' % page)
-        params = self.ruler.get_params('site:%s' % domain, page)
-        if page_url:
-            (r, soup, all_item) = self.safe_request(page_url)
-        else:
-            (r, soup, all_item) = self.safe_request(self.ruler.base_url, params=params)
-        for item in all_item:
-            self.domain_titles_map[domain].append(self.ruler.get_title(item))
-        return soup
+        (_, parsed) = self.get_serp('site:%s' % domain, page, page_url)
+        self.append_titles(domain, parsed)
+        return parsed
+
+    async def async_get_page(self, domain, page, page_url):
+        print('开始第%d页' % page)
+        (_, parsed) = await self.async_get_serp('site:%s' % domain, page, page_url)
+        self.append_titles(domain, parsed)
+        return parsed
+
+    async def async_fetch_page(self, domain, page):
+        current_page.set(page)
+        print('开始第%d页' % page)
+        (_, parsed) = await self.async_get_serp('site:%s' % domain, page, None)
+        return parsed
+
+    def append_titles(self, domain, parsed):
+        for item in parsed.items:
+            self.result_writer.append((item.title,), domain)
 
     def save_result(self):
         if not self.started:
             return
-        wb = Workbook()
-        for domain in self.domain_titles_map.keys():
-            ws = wb.create_sheet(domain, 0)
-            for title in self.domain_titles_map[domain]:
-                ws.append((title,))
-        self.domain_titles_map = {}
-        file_name = '收录标题-%s-%s.xlsx' % (self.ruler.engine_name, get_cur_time_filename())
-        wb.save(file_name)
+        with PROFILER.phase(self.ruler.engine_name, '保存结果'):
+            self.result_writer.close()
 
 
 class CheckSpider(Spider):
@@ -1101,13 +2658,12 @@ class CheckSpider(Spider):
         file_path = ''
         import_dir = '报价'
         path = '.\\%s' % import_dir
-        for file in os.listdir(path):
+        for file in list_input_files(path):
             file_path = os.path.join(path, file)
             break
-        if file_path == '' or not file_path.endswith('.xlsx'):
-            raise MyError('%s目录之下没有发现xlsx文件' % import_dir)
-        wb = load_workbook(file_path)
-        return wb.active
+        if file_path == '':
+            raise MyError('%s目录之下没有发现xlsx或者csv文件' % import_dir)
+        return input_cache.load(file_path, read_prices)
 
     def get_keyword_domain_map(self, prices):
         keyword_domains_map = {}
@@ -1115,7 +2671,7 @@ class CheckSpider(Spider):
             keywords = set()
             domains = set()
             for (index, keyword, domain, exponent, price3, price5, rank, charge) \
-                    in prices.iter_rows(min_row=2, values_only=True):
+                    in prices:
                 if index is not None:
                     keywords.add(keyword)
                     domains.add(domain)
@@ -1123,7 +2679,7 @@ class CheckSpider(Spider):
                 keyword_domains_map[keyword] = domains
         else:
             for (index, keyword, domain, exponent, price3, price5, rank, charge) \
-                    in prices.iter_rows(min_row=2, values_only=True):
+                    in prices:
                 if index is not None:
                     if keyword not in keyword_domains_map.keys():
                         keyword_domains_map[keyword] = set()
@@ -1132,6 +2688,7 @@ class CheckSpider(Spider):
 
     def get_ranks(self, ruler, keyword_domains_map):
         results, error_list = LittleRankSpider(self).get_ranks(ruler, keyword_domains_map, 1)
+        self.print_url_sources()
         self.save_error_list(error_list)
         ranks = {}
         for (domain, keyword, page, rank, _, _, _) in results:
@@ -1149,7 +2706,7 @@ class CheckSpider(Spider):
         ws = wb.active
         ws.append(('序号', '关键词', '网址', '指数', '前三名价格', '四、五名价格', '当前排名', '今日收费', '核对排名', '核对收费'))
         for (index, keyword, domain, exponent, price3, price5, rank, charge) \
-                in prices.iter_rows(min_row=2, values_only=True):
+                in prices:
             if index is not None:
                 check_rank = self.get_rank(ranks, keyword, domain)
                 check_price = self.get_price(check_rank, price3, price5)
@@ -1157,7 +2714,8 @@ class CheckSpider(Spider):
                 ws.append((index, keyword, domain, exponent, price3, price5, rank, charge, check_rank, check_price))
         ws.append((None, None, None, None, None, None, None, None, '核对总价', total_price))
         file_name = '核对结果-%s-%s.xlsx' % (self.ruler.engine_name, get_cur_time_filename())
-        wb.save(file_name)
+        with PROFILER.phase(self.ruler.engine_name, '保存结果'):
+            wb.save(file_name)
         input('核对完毕，核对结果保存在%s' % file_name)
 
     def get_rank(self, ranks, keyword, domain):
@@ -1,17 +1,39 @@
 import asyncio
+import codecs
 import datetime
 import os
+import re
+import sys
 import time
 import traceback
 from configparser import ConfigParser
+from html.parser import HTMLParser
 
 import aiohttp
 from bs4 import BeautifulSoup
-from openpyxl import load_workbook, Workbook
+from lxml import etree
+
+# 和排名爬虫共用读取导入文件的代码，打包的时候用--paths .把上一级目录加进来
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from input_reader import list_input_files, read_rows, input_cache
+from mock_transport import to_mock_url, from_mock_url
+from proxy_pool import ProxyPool, parse_proxy_list, to_aiohttp_proxy
+from result_writer import ResultWriter
 
 # import this seems unused but it's to prevent 'LookupError: unknown encoding: idna'
 import encodings.idna
 
+# 百度的验证码页面，查询是否收录的时候跳转到这里就是被判定为爬虫了
+BAIDU_FORBID_URL = 'https://wappass.baidu.com/static/captcha'
+
+# 边下载边解析，每次读这么多字节
+CHUNK_SIZE = 16 * 1024
+# 首页读到</head>就停下来，没有</head>的最多读这么多（有的网站<head>里面塞了很大的内联脚本）
+MAX_HEAD_SIZE = 512 * 1024
+# 订阅读到第一个<pubDate>就停下来，没有<pubDate>的最多读这么多
+MAX_FEED_SIZE = 2 * 1024 * 1024
+CHARSET_PATTERN = re.compile(rb'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+
 HEADERS = {
     'Accept': 'text/html,application/xhtml+xml,application/xml;'
               'q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3',
@@ -28,9 +50,9 @@ HEADERS = {
 }
 
 
+# 每个请求用自己的请求头，同时查询的网站不会互相改掉Host
 def create_headers(site):
-    HEADERS['Host'] = adjust_site(site)
-    return HEADERS
+    return dict(HEADERS, Host=adjust_site(site))
 
 
 def get_cur_time_filename():
@@ -58,15 +80,104 @@ class MyError(RuntimeError):
     pass
 
 
+class HeadParser(HTMLParser):
+    """只要首页<head>里面的<meta name="keywords">和<meta name="generator">，读到</head>或者<body>就算解析完了"""
+
+    def __init__(self):
+        super().__init__()
+        self.keywords = None
+        self.generator = None
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            name = attrs.get('name')
+            if name == 'keywords' and self.keywords is None:
+                self.keywords = attrs.get('content') or ''
+            elif name == 'generator' and self.generator is None:
+                self.generator = attrs.get('content') or ''
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            self.done = True
+
+
+# 响应头没有写编码的时候用第一块内容里面<meta charset>的编码；都没有的时候第一块能按utf-8解码就用utf-8，
+# 否则当成gb18030（兼容GBK和GB2312）；只需要<meta>的属性，个别解不出来的字节直接替换掉，不算请求出错
+def get_decoder(charset, chunk):
+    if charset is None:
+        match = CHARSET_PATTERN.search(chunk)
+        charset = match and match.group(1).decode('ascii')
+    if charset is None:
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(chunk)
+            charset = 'utf-8'
+        except UnicodeDecodeError:
+            charset = 'gb18030'
+    try:
+        return codecs.getincrementaldecoder(charset)(errors='replace')
+    except LookupError:
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+
+def parse_pub_date(dt_str):
+    if '+' in dt_str:
+        dt_str = dt_str.split('+')[0].strip()
+        return datetime.datetime.strptime(dt_str, '%a, %d %b %Y %H:%M:%S')
+    else:
+        return datetime.datetime.strptime(dt_str.strip(), '%Y-%m-%d %H:%M:%S')
+
+
+async def read_head(resp):
+    parser = HeadParser()
+    decoder = None
+    size = 0
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        if decoder is None:
+            decoder = get_decoder(resp.charset, chunk)
+        parser.feed(decoder.decode(chunk))
+        size += len(chunk)
+        if parser.done or size >= MAX_HEAD_SIZE:
+            break
+    return parser
+
+
+# 返回第一个<pubDate>的内容，没有的时候返回None；recover=True遇到不规范的订阅也能继续解析
+async def read_pub_date(resp):
+    parser = etree.XMLPullParser(events=('end',), recover=True)
+    size = 0
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        parser.feed(chunk)
+        for (_, element) in parser.read_events():
+            if isinstance(element.tag, str) and etree.QName(element).localname.lower() == 'pubdate':
+                return element.text or ''
+        size += len(chunk)
+        if size >= MAX_FEED_SIZE:
+            return None
+    return None
+
+
+def read_url_list(file_path):
+    return [row[0] for row in read_rows(file_path, columns=1) if row[0]]
+
+
 class StatusSpider:
     def __init__(self):
         self.results = {}
         self.url_list = []
-        self.wait_url_list = []
         self.complete_count = 0
+        # 已经写到结果文件的网址，保存的时候剩下的网址补上没有查询的说明
+        self.saved_urls = set()
+        self.result_writer = None
         self.cfg = ConfigParser()
         self.cfg.read('config.ini')
         self.max_count = int(self.cfg.get('config', 'max_count'))
+        self.max_count_per_host = int(self.cfg.get('config', 'max_count_per_host'))
+        self.dns_cache_seconds = int(self.cfg.get('config', 'dns_cache_seconds'))
+        self.result_format = self.cfg.get('config', 'result_format').strip()
         self.timeout = float(self.cfg.get('config', 'timeout'))
         self.search_included = self.cfg.get('config', 'search_included') == '1'
         self.search_http = self.cfg.get('config', 'search_http') == '1'
@@ -74,6 +185,10 @@ class StatusSpider:
         self.search_keywords = self.cfg.get('config', 'search_keywords') == '1'
         self.search_generator = self.cfg.get('config', 'search_generator') == '1'
         self.search_refresh_datetime = self.cfg.get('config', 'search_refresh_datetime') == '1'
+        self.mock_server = self.cfg.get('config', 'mock_server').strip()
+        # 只有查询百度是否收录用代理，网站本身的状态用代理查的话反而不准确
+        self.proxy_pool = ProxyPool(parse_proxy_list(self.cfg.get('config', 'proxy_list')),
+                                    float(self.cfg.get('config', 'proxy_cooldown')))
         self.main()
         input()
 
@@ -118,11 +233,18 @@ class StatusSpider:
     async def search(self):
         start_time = datetime.datetime.now()
         self.results = {}
-        self.url_list = self.get_input()
-        self.wait_url_list = self.url_list[self.max_count:]
+        # 重复的网址只查一次
+        self.url_list = list(dict.fromkeys(self.get_input()))
         self.complete_count = 0
-        async with aiohttp.ClientSession() as session:
-            await asyncio.gather(*[self.get_url_status(session, url) for url in self.url_list[:self.max_count]])
+        self.open_result()
+        queue = asyncio.Queue()
+        for url in self.url_list:
+            queue.put_nowait(url)
+        # 每个网站最多同时查HTTP、HTTPS和百度收录三个请求；百度收录的请求都发到同一个域名，用limit_per_host限制
+        connector = aiohttp.TCPConnector(limit=self.max_count * 3, limit_per_host=self.max_count_per_host,
+                                         ttl_dns_cache=self.dns_cache_seconds)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await asyncio.gather(*[self.worker(session, queue) for _ in range(self.max_count)])
         self.save_result()
         end_time = datetime.datetime.now()
         print('本次查询用时%s' % format_cd_time((end_time - start_time).total_seconds()))
@@ -130,15 +252,16 @@ class StatusSpider:
     def get_input(self):
         url_list = []
         path = '.\\import'
-        for file in os.listdir(path):
-            file_path = os.path.join(path, file)
-            wb = load_workbook(file_path)
-            ws = wb.active
-            for row in ws.iter_rows(values_only=True):
-                if row[0]:
-                    url_list.append(row[0])
+        for file in list_input_files(path):
+            url_list += input_cache.load(os.path.join(path, file), read_url_list)
         return url_list
 
+    # max_count个worker从同一个队列里面取网址，同时查询的网站数量一直保持在max_count
+    async def worker(self, session, queue):
+        while not queue.empty():
+            url = queue.get_nowait()
+            await self.get_url_status(session, url)
+
     async def get_url_status(self, session, url):
         print(f'开始查询 {url} 状态')
         if url not in self.results:
@@ -153,50 +276,25 @@ class StatusSpider:
         if self.search_included:
             tasks.append(asyncio.create_task(self.is_site_included(session, url)))
         await asyncio.gather(*tasks)
+        # 读取首页的时候失败了（已经返回了状态码，读取内容的时候超时或者断开）
+        if 'page_protocol' in self.results[url] and 'generator' not in self.results[url]:
+            await self.get_page_info_again(session, url)
         self.complete_count = self.complete_count + 1
+        self.write_result(url)
         print(f'{url} 状态查询结束 还剩{len(self.url_list) - self.complete_count}个正在查询')
-        if len(self.wait_url_list) != 0:
-            url = self.wait_url_list.pop(0)
-            await self.get_url_status(session, url)
 
     async def get_url(self, session, url, protocol):
         result = self.results[url]
         try:
-            async with session.get(f'{protocol}://{adjust_site(url)}',
+            async with session.get(to_mock_url(f'{protocol}://{adjust_site(url)}', self.mock_server),
                                    headers=create_headers(url),
                                    timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp:
                 result[protocol] = resp.status
-                if not self.is_all_info_collected(result):
-                    soup = BeautifulSoup(await resp.text(), 'lxml')
-                    keywords_meta = soup.find('meta', attrs={'name': 'keywords'})
-                    if keywords_meta:
-                        result['keywords'] = keywords_meta.attrs['content']
-                    else:
-                        result['keywords'] = '没有包含keyword的<meta>标签'
-                    generator_meta = soup.find('meta', attrs={'name': 'generator'})
-                    result['generator'] = generator_meta and 'wp' or 'zm'
-                    suffix = result['generator'] == 'wp' and 'feed' or 'rss.php'
-                    if self.search_refresh_datetime:
-                        try:
-                            async with session.get(f'{protocol}://{adjust_site(url)}/{suffix}',
-                                                   headers=create_headers(url),
-                                                   timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp2:
-                                soup2 = BeautifulSoup(await resp2.text(), 'lxml')
-                                pub_date = (soup2.find('pubDate') or soup2.find('pubdate'))
-                                if pub_date:
-                                    dt_str = pub_date.get_text()
-                                    if '+' in dt_str:
-                                        dt_str = dt_str.split('+')[0].strip()
-                                        dt = datetime.datetime.strptime(dt_str, '%a, %d %b %Y %H:%M:%S')
-                                    else:
-                                        dt = datetime.datetime.strptime(dt_str.strip(), '%Y-%m-%d %H:%M:%S')
-                                    result['refresh_datetime'] = dt
-                                else:
-                                    result['refresh_datetime'] = '未找到<pubdate>元素'
-                        except asyncio.TimeoutError:
-                            result['refresh_datetime'] = '查询超时'
-                        except Exception as e:
-                            result['refresh_datetime'] = format_error('查询出错', e)
+                # HTTP和HTTPS同时请求，先返回的那个读取首页，另一个只要状态码
+                if self.is_all_info_collected(result) or result.setdefault('page_protocol', protocol) != protocol:
+                    return
+                parser = await read_head(resp)
+            await self.collect_page_info(session, url, protocol, parser)
         except asyncio.TimeoutError:
             result[protocol] = '请求超时'
         except UnicodeDecodeError as e:
@@ -210,6 +308,42 @@ class StatusSpider:
         ) as e:
             result[protocol] = format_error('查询出错', e)
 
+    # 先返回的那个协议读取首页失败的时候，用另一个返回了状态码的协议重新读取，请求失败就不管了
+    async def get_page_info_again(self, session, url):
+        result = self.results[url]
+        for protocol in ('http', 'https'):
+            if protocol == result['page_protocol'] or not isinstance(result.get(protocol), int):
+                continue
+            try:
+                async with session.get(to_mock_url(f'{protocol}://{adjust_site(url)}', self.mock_server),
+                                       headers=create_headers(url),
+                                       timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp:
+                    parser = await read_head(resp)
+                await self.collect_page_info(session, url, protocol, parser)
+                return
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                pass
+
+    async def collect_page_info(self, session, url, protocol, parser):
+        result = self.results[url]
+        result['keywords'] = parser.keywords if parser.keywords is not None else '没有包含keyword的<meta>标签'
+        result['generator'] = parser.generator is not None and 'wp' or 'zm'
+        suffix = result['generator'] == 'wp' and 'feed' or 'rss.php'
+        if self.search_refresh_datetime:
+            try:
+                async with session.get(to_mock_url(f'{protocol}://{adjust_site(url)}/{suffix}', self.mock_server),
+                                       headers=create_headers(url),
+                                       timeout=aiohttp.ClientTimeout(total=self.timeout)) as resp:
+                    dt_str = await read_pub_date(resp)
+                if dt_str is not None:
+                    result['refresh_datetime'] = parse_pub_date(dt_str)
+                else:
+                    result['refresh_datetime'] = '未找到<pubdate>元素'
+            except asyncio.TimeoutError:
+                result['refresh_datetime'] = '查询超时'
+            except Exception as e:
+                result['refresh_datetime'] = format_error('查询出错', e)
+
     async def is_site_included(self, session, url):
         params = {'word': f'site:${url}'}
         headers = {
@@ -218,26 +352,50 @@ class StatusSpider:
                           'Chrome/75.0.3770.100 '
                           'Safari/537.36'
         }
-        try:
-            async with session.get(
-                    'https://www.baidu.com/s',
-                    params=params,
-                    headers=headers,
-                    timeout=aiohttp.ClientTimeout(total=self.timeout)
-            ) as resp:
-                soup = BeautifulSoup(await resp.text(), 'lxml')
-                div_root = soup.find('div', id='content_left')
-                if div_root:
-                    includes = div_root.find_all('div', recursive=False, id=lambda id_: id_ != 'rs_top_new')
-                    self.results[url]['included'] = len(includes) != 0
-                else:
-                    self.results[url]['included'] = False
-        except asyncio.TimeoutError:
-            self.results[url]['included'] = '请求超时'
-
-    def save_result(self):
-        print('开始保存查询结果')
-        name_flag_key_tuple_list = [
+        # 被判定为爬虫的时候换一个代理再查，每个代理最多试一次
+        for _ in range(len(self.proxy_pool.proxies) + 1):
+            proxy = await self.choose_proxy()
+            try:
+                async with session.get(
+                        to_mock_url('https://www.baidu.com/s', self.mock_server),
+                        params=params,
+                        headers=headers,
+                        proxy=to_aiohttp_proxy(proxy),
+                        timeout=aiohttp.ClientTimeout(total=self.timeout)
+                ) as resp:
+                    if from_mock_url(str(resp.url), self.mock_server).startswith(BAIDU_FORBID_URL):
+                        self.results[url]['included'] = '被百度判定为爬虫'
+                        if proxy is None:
+                            return
+                        self.proxy_pool.report_forbid(proxy, '百度')
+                        print(f'{self.proxy_pool.describe(proxy)}已被百度判定为爬虫，'
+                              f'暂停使用{self.proxy_pool.cooldown:.0f}秒，换一个代理重新查询 {url} 是否收录')
+                        continue
+                    self.proxy_pool.report_success(proxy, '百度')
+                    soup = BeautifulSoup(await resp.text(), 'lxml')
+                    div_root = soup.find('div', id='content_left')
+                    if div_root:
+                        includes = div_root.find_all('div', recursive=False, id=lambda id_: id_ != 'rs_top_new')
+                        self.results[url]['included'] = len(includes) != 0
+                    else:
+                        self.results[url]['included'] = False
+                    return
+            except asyncio.TimeoutError:
+                self.proxy_pool.report_failure(proxy, '百度')
+                self.results[url]['included'] = '请求超时'
+                return
+
+    # 所有代理都在暂停的时候等到有代理恢复，没有配置代理的时候返回None
+    async def choose_proxy(self):
+        while self.proxy_pool.enabled:
+            proxy = self.proxy_pool.choose('百度')
+            if proxy is not None:
+                return proxy
+            await asyncio.sleep(self.proxy_pool.get_wait_time('百度'))
+        return None
+
+    def get_name_flag_key_tuple_list(self):
+        return [
             ('百度是否收录', self.search_included, 'included',),
             ('HTTP', self.search_http, 'http',),
             ('HTTPS', self.search_https, 'https',),
@@ -246,43 +404,60 @@ class StatusSpider:
             ('更新时间', self.search_refresh_datetime, 'refresh_datetime',),
         ]
 
-        wb = Workbook()
-        ws = wb.active
-
+    def open_result(self):
+        self.saved_urls = set()
         row = ['网站', ]
-        for (name, search, _) in name_flag_key_tuple_list:
+        for (name, search, _) in self.get_name_flag_key_tuple_list():
             if search:
                 row.append(name)
-        ws.append(tuple(row))
+        self.result_writer = ResultWriter(f'状态查询-{get_cur_time_filename()}', tuple(row), self.result_format)
+        self.result_writer.open()
+
+    # 查完一个网站马上写一行，写完就不用再留在内存里面，结果文件里面的顺序是查完的先后顺序
+    def write_result(self, url):
+        if url in self.saved_urls:
+            return
+        self.result_writer.append(self.get_result_row(url, self.results.pop(url)))
+        self.saved_urls.add(url)
+
+    def get_result_row(self, url, item):
+        # 请求超时、被判定为爬虫的时候保留原来的说明
+        if 'included' in item:
+            if item['included'] is True:
+                item['included'] = '是'
+            elif item['included'] is False:
+                item['included'] = '否'
+
+        if (self.search_http and item['http'] != 200) and (self.search_https and item['https'] != 200):
+            for key in ['keywords', 'generator', 'refresh_datetime', ]:
+                if key not in item:
+                    item[key] = '由于无法请求到页面，所以未能查询到信息'
+
+        row = [url]
+        for (_, search, key) in self.get_name_flag_key_tuple_list():
+            if search:
+                row.append((key in item) and item[key] or '由于未知原因，未能查询到信息')
+        return tuple(row)
 
+    # 正常结束的时候所有网址都已经写过了；强行终止或者出错的时候补上还没有写的网址
+    def save_result(self):
+        if self.result_writer is None:
+            return
+        print('开始保存查询结果')
         for url in self.url_list:
+            if url in self.saved_urls:
+                continue
             if url in self.results:
-                item = self.results[url]
-
-                if 'included' in item:
-                    if item['included']:
-                        item['included'] = '是'
-                    else:
-                        item['included'] = '否'
-
-                if (self.search_http and item['http'] != 200) and (self.search_https and item['https'] != 200):
-                    for key in ['keywords', 'generator', 'refresh_datetime', ]:
-                        if key not in item:
-                            item[key] = '由于无法请求到页面，所以未能查询到信息'
-
-                row = [url]
-                for (_, search, key) in name_flag_key_tuple_list:
-                    if search:
-                        row.append((key in item) and item[key] or '由于未知原因，未能查询到信息')
-                ws.append(tuple(row))
+                self.result_writer.append(self.get_result_row(url, self.results.pop(url)))
             else:
                 row = [url]
-                for (_, search, _) in name_flag_key_tuple_list:
+                for (_, search, _) in self.get_name_flag_key_tuple_list():
                     if search:
                         row.append('由于强行终止程序或者发生异常，未能进行查询')
-                ws.append(tuple(row))
-        file_name = f'状态查询-{get_cur_time_filename()}.xlsx'
-        wb.save(file_name)
+                self.result_writer.append(tuple(row))
+            self.saved_urls.add(url)
+        file_name = self.result_writer.close()
+        self.result_writer = None
         print(f'查询结果保存在 {file_name}')
 
     def is_all_info_collected(self, result):
@@ -0,0 +1,179 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+
+# 任务数据库的格式版本，存在sqlite的user_version里面；0是关键词还没有存成JSON的旧格式
+SCHEMA_VERSION = 1
+
+
+# 从xlsx读到的关键词可能是数字（例如2013），数据库里面存JSON，取出来的时候还是原来的类型，和keyword_domains_map的键一样
+def encode_keyword(keyword):
+    return json.dumps(keyword, ensure_ascii=False)
+
+
+class WorkQueue:
+    """多台机器（不同的出口IP）一起查询排名：协调节点把导入文件拆成(搜索引擎, 关键词)的任务写到共享磁盘上的sqlite文件，
+    每个节点领取任务的时候拿到一段时间的租约，查询过程中定时续租；节点退出或者断网之后租约过期，任务会被其他节点重新领取
+    查完的结果写回数据库，所有任务都查完之后由协调节点合并成一个结果文件
+    租约时间用的是各台机器自己的时钟，机器之间的时间差要比lease_seconds小很多"""
+
+    def __init__(self, path, lease_seconds, worker_name=None):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.worker_name = worker_name or '%s-%s' % (socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        # 自己领取了还没有查完的任务：(批次, 搜索引擎, JSON格式的关键词)
+        self.held = set()
+        self.keeper = None
+        # isolation_level=None自己控制事务，领取任务的时候用BEGIN IMMEDIATE，两个节点不会领到同一个任务
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60, isolation_level=None)
+        self.check_version()
+        self.conn.execute('CREATE TABLE IF NOT EXISTS units '
+                          '(batch TEXT NOT NULL, engine TEXT NOT NULL, keyword TEXT NOT NULL, domains TEXT NOT NULL, '
+                          'worker TEXT, lease_until REAL NOT NULL DEFAULT 0, done INTEGER NOT NULL DEFAULT 0, '
+                          'result TEXT, PRIMARY KEY (batch, engine, keyword))')
+
+    # 旧格式的任务读出来的关键词对不上，不能混在一起用；空的数据库直接标记成新格式
+    def check_version(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+        has_units = self.conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'units'"
+                                      ).fetchone()[0] != 0
+        if version != 0 or (has_units and self.conn.execute('SELECT COUNT(*) FROM units').fetchone()[0] != 0):
+            raise ValueError('任务数据库%s是旧版本的程序写入的，请等所有节点都退出之后删掉这个文件重新开始' % self.path)
+        self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    # 批次就是导入文件的文件名，已经有的任务不会重复添加（上次没有查完的接着查）
+    def add_units(self, batch, engine, keyword_domains_map):
+        # 同样的域名集合存成同样的字符串，读出来的时候共用一个set；域名里面有数字的时候按字符串排序
+        rows = [(batch, engine, encode_keyword(keyword), json.dumps(sorted(domains, key=str), ensure_ascii=False))
+                for keyword, domains in keyword_domains_map.items()]
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.executemany('INSERT OR IGNORE INTO units (batch, engine, keyword, domains) VALUES (?, ?, ?, ?)',
+                                      rows)
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    # 还有任务没有查完的批次
+    def get_batches(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute('SELECT DISTINCT batch FROM units WHERE done = 0 ORDER BY batch')]
+
+    # 和read_keyword_domains_map的返回值一样，域名一样的关键词共用同一个set，编译DomainMatcher的时候只编译一次
+    def get_keyword_domains_map(self, batch):
+        with self.lock:
+            rows = list(self.conn.execute('SELECT DISTINCT keyword, domains FROM units WHERE batch = ?', (batch,)))
+        domain_sets = {}
+        keyword_domains_map = {}
+        for (keyword, domains) in rows:
+            if domains not in domain_sets:
+                domain_sets[domains] = set(json.loads(domains))
+            keyword_domains_map[json.loads(keyword)] = domain_sets[domains]
+        return keyword_domains_map
+
+    # 领取一个没有人在查（或者租约已经过期）的任务，返回关键词，没有可以领取的任务返回None
+    def lease(self, batch, engine):
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT keyword FROM units WHERE batch = ? AND engine = ? AND done = 0 '
+                                        'AND lease_until < ? LIMIT 1', (batch, engine, now)).fetchone()
+                if row is not None:
+                    self.conn.execute('UPDATE units SET worker = ?, lease_until = ? '
+                                      'WHERE batch = ? AND engine = ? AND keyword = ?',
+                                      (self.worker_name, now + self.lease_seconds, batch, engine, row[0]))
+                self.conn.execute('COMMIT')
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            if row is None:
+                return None
+            self.held.add((batch, engine, row[0]))
+        self.start_keeper()
+        return json.loads(row[0])
+
+    # 查完一个任务，result和unsafe_items是RankSpider.write_result的参数；租约过期之后被别人查完了的以先查完的为准
+    def complete(self, batch, engine, keyword, result, unsafe_items):
+        value = json.dumps({
+            'result': [(domain, keyword, page, rank, url, title, date_time.timestamp())
+                       for (domain, keyword, page, rank, url, title, date_time) in result],
+            'unsafe': unsafe_items,
+            'worker': self.worker_name,
+        }, ensure_ascii=False)
+        keyword = encode_keyword(keyword)
+        with self.lock:
+            self.held.discard((batch, engine, keyword))
+            self.conn.execute('UPDATE units SET done = 1, result = ? '
+                              'WHERE batch = ? AND engine = ? AND keyword = ? AND done = 0',
+                              (value, batch, engine, keyword))
+
+    # 程序出错退出之前把手上的任务还回去，其他节点马上就可以领取，不用等租约过期
+    def release_held(self):
+        with self.lock:
+            for (batch, engine, keyword) in self.held:
+                self.conn.execute('UPDATE units SET lease_until = 0 '
+                                  'WHERE batch = ? AND engine = ? AND keyword = ? AND worker = ? AND done = 0',
+                                  (batch, engine, keyword, self.worker_name))
+            self.held.clear()
+
+    def count_unfinished(self, batch, engine):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM units WHERE batch = ? AND engine = ? AND done = 0',
+                                     (batch, engine)).fetchone()[0]
+
+    # 返回[(关键词, 排名结果, 安全提醒)]，结果里面的时间已经转换回datetime
+    def get_results(self, batch, engine):
+        with self.lock:
+            rows = list(self.conn.execute('SELECT keyword, result FROM units WHERE batch = ? AND engine = ? AND done = 1',
+                                          (batch, engine)))
+        results = []
+        for (keyword, value) in rows:
+            record = json.loads(value)
+            result = [(domain, keyword, page, rank, url, title, datetime.fromtimestamp(timestamp))
+                      for (domain, keyword, page, rank, url, title, timestamp) in record['result']]
+            results.append((json.loads(keyword), result, [tuple(item) for item in record['unsafe']]))
+        return results
+
+    # 合并完结果之后删掉，下次查询同一个导入文件的时候重新分配
+    def remove_batch(self, batch, engine):
+        with self.lock:
+            self.conn.execute('DELETE FROM units WHERE batch = ? AND engine = ?', (batch, engine))
+
+    def start_keeper(self):
+        with self.lock:
+            if self.keeper is not None:
+                return
+            self.keeper = threading.Thread(target=self.keep_leases, daemon=True)
+        self.keeper.start()
+
+    # 每隔三分之一的租约时间给手上的任务续租
+    def keep_leases(self):
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self.lock:
+                until = time.time() + self.lease_seconds
+                for (batch, engine, keyword) in self.held:
+                    self.conn.execute('UPDATE units SET lease_until = ? '
+                                      'WHERE batch = ? AND engine = ? AND keyword = ? AND worker = ? AND done = 0',
+                                      (until, batch, engine, keyword, self.worker_name))
+
+
+queues = {}
+
+
+# 同一个进程里面的所有搜索引擎（AllRankSpider）共用一个连接和续租线程
+def open_work_queue(path, lease_seconds):
+    if path not in queues:
+        queues[path] = WorkQueue(path, lease_seconds)
+    return queues[path]